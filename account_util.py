@@ -1,38 +1,151 @@
-import boto
-import boto.ec2
 import codecs
+import collections
+import contextlib
+import functools
+import heapq
+import itertools
 import logging
+import mailbox
+import math
+import multiprocessing
 import random
+import signal
 import subprocess
 import os
 import os.path
+import pipes
+import threading
 import time
+import uuid
+from multiprocessing.pool import ThreadPool
 
 import sqlite3
 
+import instrumentation
+
+class _LazyBoto(object):
+    ## boto takes longer to import than most commands take to run against
+    ## creds.db alone, so it is only imported once something uses it
+    def __getattr__(self, name):
+        import boto
+        import boto.ec2
+        import boto.exception
+        import boto.resultset
+        return getattr(boto, name)
+
+boto = _LazyBoto()
+
 LOGGER = logging.getLogger(__name__)
 
 POLL_DELAY = 10
+## instances that are slow to change state are polled progressively less
+## often, starting at POLL_MIN_DELAY and backing off up to POLL_DELAY
+POLL_MIN_DELAY = 2
+POLL_BACKOFF = 1.5
+## checks due within this window of each other share a DescribeInstances call
+POLL_COALESCE = 1
+
+PASSWORD_WORDS = 3
+
+## seconds a writer waits for another thread's lock on creds.db
+DB_TIMEOUT = 60
+## BatchWriter commits once this many writes are queued, or when a write
+## arrives this many seconds after the last commit
+DB_BATCH_SIZE = 50
+DB_BATCH_INTERVAL = 1.0
+
+## EC2 accepts at most 1000 results per DescribeInstances page; lists of
+## instance IDs are sent in smaller chunks to keep requests reasonably sized.
+DESCRIBE_PAGE_SIZE = 1000
+EC2_BATCH_SIZE = 200
+## instances requested per RunInstances call when they share --launch_key
+LAUNCH_BATCH_SIZE = 50
+
+## Every EC2/IAM call takes a token from its service's bucket, shared by all
+## threads; --ec2_rate / --iam_rate set the refill rate (calls per second)
+## and API_BURST how many calls may go out back to back.
+API_BURST = 10
+## throttled or transient errors are retried up to API_MAX_ATTEMPTS times,
+## sleeping a random time of up to API_BACKOFF_BASE * 2**attempt seconds
+## (capped at API_BACKOFF_MAX) between attempts
+API_MAX_ATTEMPTS = 8
+API_BACKOFF_BASE = 0.5
+API_BACKOFF_MAX = 30
+## A throttled call was never carried out, so any call is retried. After
+## a server error the call may or may not have taken effect, so only calls
+## that are safe to repeat are retried: reads (get_*), the writes below,
+## and run_instances, which is given a ClientToken to make it idempotent.
+API_THROTTLE_CODES = ['RequestLimitExceeded', 'Throttling', 'ThrottlingException']
+API_RETRY_CODES = API_THROTTLE_CODES + [
+    'ServiceUnavailable', 'Unavailable', 'InternalError', 'InternalFailure',
+]
+API_IDEMPOTENT_CALLS = [
+    'run_instances', 'create_tags', 'delete_tags', 'stop_instances', 'terminate_instances',
+    'put_user_policy', 'put_group_policy',
+]
+
+ACTIVE_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+## cached instances in these states are re-described on every read
+TRANSITIONAL_INSTANCE_STATES = ['pending', 'stopping']
 
 SSH_OPTIONS = [
     '-o', 'ConnectTimeout=5',
     '-o', 'UserKnownHostsFile=/dev/null',
     '-o', 'StrictHostKeyChecking=no',
 ]
+## exec/push runs share one SSH connection per host: the first ssh becomes
+## the master and later ssh/scp runs (this run or one started within
+## SSH_CONTROL_PERSIST seconds) reuse it
+SSH_CONTROL_PERSIST = 120
+
+## spooled credential emails (see email_keys.py) name their account in this header
+SPOOL_ACCOUNT_HEADER = 'X-EC2Tools-Account'
 
 def setup_args(parser):
     group = parser.add_argument_group('account_util')
-    group.add_argument('--aws_region', default='us-west-2')
+    group.add_argument('--aws_region', default='us-west-2',
+        help='a region, or a comma-separated list to work across all of them')
     group.add_argument('--profile', default=os.environ.get('AWS_PROFILE'))
     group.add_argument('--creds_db', default='creds.db')
     group.add_argument('--ssh_key_dir', default='ssh-keys')
     group.add_argument('--password_wordlist', default='diceware_list.txt')
     group.add_argument('--default_group', default='students')
     group.add_argument('--default_security_group', default='students')
-    group.add_argument('--instance_up_wait', default=120)
-    group.add_argument('--instance_stop_wait', default=180)
-    group.add_argument('--instance_pending_wait', default=600)
+    group.add_argument('--policy_mode', choices=['user', 'group'], default='user',
+        help='user: an inline policy per user; group: one policy on --default_group '
+             '(run migrate_policy.py once to switch existing accounts)')
+    group.add_argument('--instance_up_wait', type=int, default=120)
+    group.add_argument('--instance_stop_wait', type=int, default=180)
+    group.add_argument('--instance_pending_wait', type=int, default=600)
+    group.add_argument('--instance_terminate_wait', type=int, default=300)
     group.add_argument('--ssh_user_name', default='ec2-user')
+    group.add_argument('--launch_key', default=None,
+        help='launch every instance with this key pair (its private key in --ssh_key_dir) '
+             'instead of each user\'s own, so instances can be launched in batches; '
+             'each user\'s own public key is added to their instance once it is up')
+    group.add_argument('--ssh_probe_jobs', type=int, default=32)
+    group.add_argument('--ssh_jobs', type=int, default=32,
+        help='hosts to run remote commands or copies on at once')
+    group.add_argument('--ssh_timeout', type=int, default=300,
+        help='seconds allowed per host for a remote command or copy')
+    group.add_argument('--ssh_control_path', default='~/.ssh/ec2tools-%C',
+        help='ssh ControlPath for the shared per-host connections')
+    group.add_argument('--ec2_rate', type=float, default=20.0,
+        help='EC2 API calls per second, shared by all threads')
+    group.add_argument('--iam_rate', type=float, default=10.0,
+        help='IAM API calls per second, shared by all threads')
+
+    group.add_argument('--inventory_ttl', type=int, default=300,
+        help='seconds before the cached instance inventory in --creds_db is fully refreshed')
+    group.add_argument('--refresh', action='store_true', default=False,
+        help='ignore the cached instance inventory and pull it from EC2')
+
+    group.add_argument('--spool_dir', default='email-spool',
+        help='maildir that email_keys.py renders credential emails into until they are sent')
+
+    group.add_argument('--profile_report', default=None,
+        help='at exit, write call counts and latencies per phase, API operation and SSH probe '
+             'to this file (JSON if it ends in .json, a table otherwise; - for stderr)')
 
     group.add_argument('--boto_log_level', choices=['DEBUG','INFO','WARNING','ERROR', 'CRITICAL'], default='INFO')
     group.add_argument('--account_util_log_level', choices=['DEBUG','INFO','WARNING','ERROR', 'CRITICAL'], default='DEBUG')
@@ -42,15 +155,27 @@ def setup_args(parser):
     parser.add_argument('--users_from_list', default=None)
 
     parser.add_argument('--ssh_keygen', default='ssh-keygen')
+    parser.add_argument('--ssh', default='ssh')
+    parser.add_argument('--scp', default='scp')
     parser.add_argument('--reuse_keys', default=False, action='store_true')
+    parser.add_argument('--resume', default=False, action='store_true',
+        help='continue an interrupted run from the steps journaled in --creds_db')
+    parser.add_argument('--keygen_jobs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--jobs', type=int, default=1,
+        help='number of users to provision concurrently')
+
+def read_roster(args):
+    roster = []
+    with codecs.open(args.users_from_list, 'r', 'utf-8') as fh:
+        for line in fh:
+            name, user_name, rest = line.split('\t', 2)
+            roster.append((name, user_name))
+    return roster
 
 def get_users(args):
     if args.users_from_list:
         assert(not args.users)
-        user_list = []
-        with codecs.open(args.users_from_list, 'r', 'utf-8') as fh:
-            for line in fh:
-                user_list.append(line.split('\t')[1])
+        user_list = [user_name for name, user_name in read_roster(args)]
     elif args.users:
         user_list = args.users.split(',')
     else:
@@ -63,15 +188,483 @@ def init_logging(args):
     logging.basicConfig()
     LOGGER.setLevel(logging.__dict__[args.account_util_log_level])
     logging.getLogger('boto').setLevel(logging.__dict__[args.boto_log_level])
+    if args.profile_report:
+        instrumentation.enable(args.profile_report)
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        ## blocks until a call may go out; returns the seconds spent waiting
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+_API_BUCKETS = {}
+_API_STATS = {}
+_API_LOCK = threading.Lock()
+
+def _api_bucket(service, rate):
+    with _API_LOCK:
+        if service not in _API_BUCKETS:
+            _API_BUCKETS[service] = TokenBucket(rate, API_BURST)
+            _API_STATS[service] = {'calls': 0, 'retries': 0, 'rate_wait': 0.0, 'backoff_wait': 0.0}
+        return _API_BUCKETS[service]
+
+def _count_api(service, **amounts):
+    with _API_LOCK:
+        for key, amount in amounts.iteritems():
+            _API_STATS[service][key] += amount
+
+def api_stats():
+    ## service -> calls, retries and seconds spent waiting on the rate limit
+    ## and on backoff, summed over all threads
+    with _API_LOCK:
+        return dict((service, dict(stats)) for service, stats in _API_STATS.iteritems())
+
+def _is_retryable(name, e):
+    if getattr(e, 'error_code', None) in API_THROTTLE_CODES:
+        return True
+    if not (name.startswith('get_') or name in API_IDEMPOTENT_CALLS):
+        return False
+    return getattr(e, 'error_code', None) in API_RETRY_CODES or getattr(e, 'status', 0) >= 500
+
+class ThrottledConnection(object):
+    ## Wraps a boto connection so that every method call is rate limited by
+    ## the service's shared TokenBucket and retried on throttling.
+    def __init__(self, service, connection, rate):
+        self.service = service
+        self.connection = connection
+        self.bucket = _api_bucket(service, rate)
+
+    def __getattr__(self, name):
+        attr = getattr(self.connection, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        def call(*call_args, **call_kwargs):
+            return self._call(name, attr, call_args, call_kwargs)
+        call.__name__ = name
+        return call
+
+    def _call(self, name, method, call_args, call_kwargs):
+        if name == 'run_instances' and call_kwargs.get('client_token') is None:
+            ## a retry with the same token cannot start a second set of instances
+            call_kwargs = dict(call_kwargs, client_token=str(uuid.uuid4()))
+        attempt = 0
+        start = time.time()
+        while True:
+            _count_api(self.service, calls=1, rate_wait=self.bucket.acquire())
+            try:
+                result = method(*call_args, **call_kwargs)
+                instrumentation.record('api', '%s.%s' % (self.service, name),
+                    time.time() - start, retries=attempt)
+                return result
+            except boto.exception.BotoServerError as e:
+                attempt += 1
+                if not _is_retryable(name, e) or attempt >= API_MAX_ATTEMPTS:
+                    instrumentation.record('api', '%s.%s' % (self.service, name),
+                        time.time() - start, retries=attempt - 1)
+                    raise
+                delay = random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt))
+                LOGGER.debug('%s.%s throttled (%s), retrying in %.1fs',
+                    self.service, name, e.error_code, delay)
+                _count_api(self.service, retries=1, backoff_wait=delay)
+                time.sleep(delay)
+
+## instance ID -> region name for every instance a MultiRegionEC2 has seen,
+## shared by all threads' connections
+_INSTANCE_REGIONS = {}
+_INSTANCE_REGIONS_LOCK = threading.Lock()
+
+def _map_regions(function, regions):
+    ## one short-lived thread per region; function must not raise
+    if len(regions) == 1:
+        return {regions[0]: function(regions[0])}
+    results = {}
+    def run(region):
+        results[region] = function(region)
+    threads = [threading.Thread(target=run, args=(region,)) for region in regions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def _not_found_error(message):
+    error = boto.exception.EC2ResponseError(400, message)
+    error.error_code = 'InvalidInstanceID.NotFound'
+    return error
+
+class MultiRegionEC2(object):
+    ## Stands in for one EC2 connection across several regions (a list in
+    ## --aws_region). Describes fan out to every region at once and are
+    ## merged; calls taking instance IDs go to the region each instance was
+    ## described or launched in; key pairs are imported into and deleted from
+    ## every region; launches go to the regions in turn.
+    def __init__(self, connections):
+        ## region name -> connection
+        self.connections = connections
+        self.regions = sorted(connections)
+        self._next_region = itertools.cycle(self.regions)
+        self._lock = threading.Lock()
+
+    def _remember(self, region, instances):
+        with _INSTANCE_REGIONS_LOCK:
+            for instance in instances:
+                _INSTANCE_REGIONS[instance.id] = region
+
+    def _route(self, instance_ids):
+        by_region = {}
+        with _INSTANCE_REGIONS_LOCK:
+            unknown = [instance_id for instance_id in instance_ids if instance_id not in _INSTANCE_REGIONS]
+            for instance_id in instance_ids:
+                if instance_id in _INSTANCE_REGIONS:
+                    by_region.setdefault(_INSTANCE_REGIONS[instance_id], []).append(instance_id)
+        if len(unknown) > 0:
+            raise _not_found_error('region of %s is not known; describe them first' % unknown)
+        return by_region
+
+    def _each_region(self, name, regions, region_kwargs, raise_errors=True):
+        ## calls name on each region's connection concurrently; returns
+        ## region -> result, or region -> (result, error) if not raise_errors
+        def call(region):
+            try:
+                return getattr(self.connections[region], name)(**region_kwargs(region)), None
+            except boto.exception.BotoServerError as e:
+                return None, e
+            except Exception as e:
+                LOGGER.exception('%s failed in %s', name, region)
+                return None, e
+        results = _map_regions(call, regions)
+        if not raise_errors:
+            return results
+        for region in sorted(results):
+            if results[region][1] is not None:
+                raise results[region][1]
+        return dict((region, result) for region, (result, error) in results.iteritems())
+
+    def _call_routed(self, name, instance_ids):
+        by_region = self._route(instance_ids)
+        return self._each_region(name, sorted(by_region),
+            lambda region: {'instance_ids': by_region[region]}).values()
+
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        ## next_token holds the next token of each region that has more pages;
+        ## to describe particular instances, filter on instance-id
+        filters = dict(filters or {})
+        if next_token is not None:
+            tokens = next_token
+        else:
+            tokens = dict((region, None) for region in self.regions)
+        regional_filters = dict((region, filters) for region in tokens)
+        if 'instance-id' in filters:
+            ## only ask the regions the instances are in
+            ids = filters['instance-id']
+            if not isinstance(ids, list):
+                ids = [ids]
+            with _INSTANCE_REGIONS_LOCK:
+                if all(instance_id in _INSTANCE_REGIONS for instance_id in ids):
+                    for region in list(regional_filters):
+                        region_ids = [instance_id for instance_id in ids
+                                      if _INSTANCE_REGIONS[instance_id] == region]
+                        if len(region_ids) == 0:
+                            del regional_filters[region]
+                        else:
+                            regional_filters[region] = dict(filters, **{'instance-id': region_ids})
+        pages = self._each_region('get_all_reservations', sorted(regional_filters),
+            lambda region: {'filters': regional_filters[region], 'max_results': max_results,
+                            'next_token': tokens[region]})
+        result = boto.resultset.ResultSet()
+        next_tokens = {}
+        for region, reservations in sorted(pages.iteritems()):
+            for reservation in reservations:
+                self._remember(region, reservation.instances)
+                result.append(reservation)
+            if reservations.next_token:
+                next_tokens[region] = reservations.next_token
+        result.next_token = next_tokens or None
+        return result
+
+    get_all_instances = get_all_reservations
+
+    def run_instances(self, image_id, **call_kwargs):
+        ## image_id is region -> AMI (see launch_image_id), as AMI IDs are per region
+        with self._lock:
+            region = next(self._next_region)
+        reservation = self.connections[region].run_instances(image_id=image_id[region], **call_kwargs)
+        self._remember(region, reservation.instances)
+        return reservation
+
+    def create_tags(self, resource_ids, tags):
+        by_region = self._route(resource_ids)
+        self._each_region('create_tags', sorted(by_region),
+            lambda region: {'resource_ids': by_region[region], 'tags': tags})
+        return True
+
+    def delete_tags(self, resource_ids, tags):
+        by_region = self._route(resource_ids)
+        self._each_region('delete_tags', sorted(by_region),
+            lambda region: {'resource_ids': by_region[region], 'tags': tags})
+        return True
+
+    def stop_instances(self, instance_ids):
+        return sum(self._call_routed('stop_instances', instance_ids), [])
+
+    def terminate_instances(self, instance_ids):
+        return sum(self._call_routed('terminate_instances', instance_ids), [])
+
+    def import_key_pair(self, key_name, public_key_material):
+        results = self._each_region('import_key_pair', self.regions,
+            lambda region: {'key_name': key_name, 'public_key_material': public_key_material},
+            raise_errors=False)
+        errors = [error for key_pair, error in results.itervalues() if error is not None]
+        ## a key pair already present in some regions is only an error if
+        ## it was present everywhere, as with one region
+        if len([error for error in errors if getattr(error, 'error_code', None) != 'InvalidKeyPair.Duplicate']) > 0 \
+                or len(errors) == len(self.regions):
+            raise errors[0]
+        return [key_pair for key_pair, error in results.itervalues() if key_pair is not None][0]
+
+    def delete_key_pair(self, key_name):
+        self._each_region('delete_key_pair', self.regions, lambda region: {'key_name': key_name})
+        return True
+
+    def get_all_key_pairs(self):
+        ## only key pairs present in every region count
+        key_pairs = self._each_region('get_all_key_pairs', self.regions, lambda region: {})
+        names = None
+        for region in self.regions:
+            region_names = set(key_pair.name for key_pair in key_pairs[region])
+            names = region_names if names is None else names & region_names
+        return [key_pair for key_pair in key_pairs[self.regions[0]] if key_pair.name in names]
+
+def image_ids(args):
+    ## region -> AMI for every region in --aws_region. --ami is one AMI, or
+    ## region=AMI,... since an AMI ID only exists in one region; raises
+    ## ValueError if a region has none.
+    regions = args.aws_region.split(',')
+    if '=' not in args.ami:
+        if len(regions) > 1:
+            raise ValueError('AMI IDs differ between regions; give --ami as region=AMI,... for %s'
+                             % ','.join(regions))
+        return {regions[0]: args.ami}
+    amis = dict(entry.split('=', 1) for entry in args.ami.split(','))
+    missing = [region for region in regions if region not in amis]
+    if len(missing) > 0:
+        raise ValueError('--ami has no AMI for %s' % ','.join(missing))
+    return dict((region, amis[region]) for region in regions)
+
+def launch_image_id(args):
+    ## the image_id to launch with: an AMI, or region -> AMI for MultiRegionEC2
+    images = image_ids(args)
+    if len(images) == 1:
+        return images.values()[0]
+    return images
+
+def _connect_region(args, region):
+    return boto.ec2.connect_to_region(region, profile_name=args.profile)
 
 def connect_ec2(args):
-    return boto.ec2.connect_to_region(args.aws_region, profile_name=args.profile)
+    regions = args.aws_region.split(',')
+    if len(regions) == 1:
+        return ThrottledConnection('ec2', _connect_region(args, regions[0]), args.ec2_rate)
+    ## EC2 rate limits are per region, so each region gets its own bucket
+    return MultiRegionEC2(dict(
+        (region, ThrottledConnection('ec2.' + region, _connect_region(args, region), args.ec2_rate))
+        for region in regions))
 
 def connect_iam(args):
-    return boto.connect_iam(profile_name=args.profile)
+    return ThrottledConnection('iam', boto.connect_iam(profile_name=args.profile), args.iam_rate)
 
-def connect_db(args):
-    return sqlite3.connect(args.creds_db, isolation_level=None)
+## Each entry upgrades the schema by one version (tracked in PRAGMA
+## user_version); add new tables by appending an entry, never by editing one.
+SCHEMA_MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_name TEXT PRIMARY KEY,
+            name TEXT,
+            note TEXT,
+            password TEXT
+        )
+        """,
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            user_name TEXT PRIMARY KEY,
+            status TEXT,
+            error TEXT,
+            updated REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS instances (
+            instance_id TEXT PRIMARY KEY,
+            user_name TEXT,
+            state TEXT,
+            instance_type TEXT,
+            public_dns_name TEXT,
+            tagged INTEGER,
+            updated REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS instances_user_name ON instances (user_name)",
+        "CREATE INDEX IF NOT EXISTS instances_state ON instances (state)",
+        """
+        CREATE TABLE IF NOT EXISTS inventory_refreshes (
+            name TEXT PRIMARY KEY,
+            refreshed REAL
+        )
+        """,
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS steps (
+            user_name TEXT,
+            step TEXT,
+            detail TEXT,
+            completed REAL,
+            PRIMARY KEY (user_name, step)
+        )
+        """,
+    ],
+    [
+        "ALTER TABLE instances ADD COLUMN region TEXT",
+    ],
+]
+
+def connect_db(args, check_same_thread=True):
+    dbh = sqlite3.connect(args.creds_db, isolation_level=None, timeout=DB_TIMEOUT,
+                          check_same_thread=check_same_thread)
+    ## WAL lets readers run alongside a writer, and with it synchronous=NORMAL
+    ## only syncs at checkpoints rather than on every commit
+    dbh.execute('PRAGMA journal_mode=WAL')
+    dbh.execute('PRAGMA synchronous=NORMAL')
+    migrate_db(args, dbh)
+    return dbh
+
+@contextlib.contextmanager
+def transaction(dbh):
+    dbh.execute('BEGIN IMMEDIATE')
+    try:
+        yield dbh
+    except:
+        dbh.execute('ROLLBACK')
+        raise
+    dbh.execute('COMMIT')
+
+def schema_version(dbh):
+    return dbh.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate_db(args, dbh):
+    if schema_version(dbh) >= len(SCHEMA_MIGRATIONS):
+        return
+    with transaction(dbh):
+        ## re-read under the write lock in case another process migrated first
+        version = schema_version(dbh)
+        for statements in SCHEMA_MIGRATIONS[version:]:
+            for statement in statements:
+                dbh.execute(statement)
+        dbh.execute('PRAGMA user_version = %d' % len(SCHEMA_MIGRATIONS))
+
+class BatchWriter(object):
+    ## Thread-safe stand-in for a dbh's execute(): writes from any number of
+    ## worker threads are queued and committed together in one transaction
+    ## once DB_BATCH_SIZE are pending or DB_BATCH_INTERVAL has passed.
+    def __init__(self, args):
+        self.dbh = connect_db(args, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.time()
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            self._pending.append((sql, params))
+            if (len(self._pending) >= DB_BATCH_SIZE or
+                    time.time() - self._last_flush >= DB_BATCH_INTERVAL):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self._pending) > 0:
+            with transaction(self.dbh):
+                for sql, params in self._pending:
+                    self.dbh.execute(sql, params)
+            self._pending = []
+        self._last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.dbh.close()
+
+## boto connections are not shared between threads: each thread checks out
+## its own, lazily, and they return to _IDLE_CONNECTIONS when the thread
+## exits, so the next pool's workers (or the next ec2tools command) reuse
+## them instead of reconnecting. Database writes from workers go through a
+## shared BatchWriter instead.
+_IDLE_CONNECTIONS = {}
+_IDLE_LOCK = threading.Lock()
+_THREAD_STATE = threading.local()
+
+class _CheckedOutConnections(dict):
+    ## key -> connection, for one thread
+    def __init__(self):
+        dict.__init__(self)
+        ## kept here as module globals may be gone by the time __del__ runs
+        self.idle = _IDLE_CONNECTIONS
+        self.idle_lock = _IDLE_LOCK
+
+    def __del__(self):
+        with self.idle_lock:
+            for key, connection in self.iteritems():
+                self.idle.setdefault(key, []).append(connection)
+
+def _pooled_connection(args, key, connect):
+    checked_out = getattr(_THREAD_STATE, 'connections', None)
+    if checked_out is None:
+        checked_out = _THREAD_STATE.connections = _CheckedOutConnections()
+    if key not in checked_out:
+        with _IDLE_LOCK:
+            idle = _IDLE_CONNECTIONS.get(key)
+            connection = idle.pop() if idle else None
+        checked_out[key] = connection if connection is not None else connect(args)
+    return checked_out[key]
+
+def iam_connection(args):
+    return _pooled_connection(args, ('iam', args.profile), connect_iam)
+
+def ec2_connection(args):
+    return _pooled_connection(args, ('ec2', args.profile, args.aws_region), connect_ec2)
+
+def thread_connections(args):
+    return iam_connection(args), ec2_connection(args)
+
+def reset_connections():
+    ## forgets every connection, e.g. once connect_ec2/connect_iam are replaced
+    _THREAD_STATE.connections = None
+    with _IDLE_LOCK:
+        _IDLE_CONNECTIONS.clear()
 
 def fill_dbh(args, dbh):
     if not dbh:
@@ -80,38 +673,80 @@ def fill_dbh(args, dbh):
         return dbh
 
 def init_db(args, dbh):
-    dbh.executescript("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_name TEXT PRIMARY KEY,
-            name TEXT,
-            note TEXT,
-            password TEXT
-        );
-    """)
+    migrate_db(args, dbh)
+
+_WORDLISTS = {}
+_WORDLIST_LOCK = threading.Lock()
+_RNG = random.SystemRandom()
+
+def load_wordlist(args):
+    ## read once per process and kept as a tuple of words
+    with _WORDLIST_LOCK:
+        if args.password_wordlist not in _WORDLISTS:
+            with open(args.password_wordlist, 'r') as fh:
+                words = tuple(word for word in (line.strip() for line in fh) if word)
+            _WORDLISTS[args.password_wordlist] = words
+        return _WORDLISTS[args.password_wordlist]
+
+def password_entropy(args):
+    return PASSWORD_WORDS * math.log(len(load_wordlist(args)), 2)
+
+def generate_passwords(args, count):
+    words = load_wordlist(args)
+    return [' '.join([_RNG.choice(words) for i in range(PASSWORD_WORDS)]) for j in range(count)]
 
 def generate_password(args):
-    with open(args.password_wordlist, 'r') as fh:
-        words = map(lambda s: s.strip(), fh.readlines())
-    rng = random.SystemRandom()
-    return ' '.join([random.choice(words) for i in range(3)])
+    return generate_passwords(args, 1)[0]
+
+def has_key_files(args, name):
+    return (os.path.exists(os.path.join(args.ssh_key_dir, name)) or
+            os.path.exists(os.path.join(args.ssh_key_dir, name + '.pub')))
 
 def _generate_keypair(args, name):
     if not args.reuse_keys or not os.path.exists(os.path.join(args.ssh_key_dir, name)):
-        subprocess.check_call([
-            args.ssh_keygen, '-N', '', '-t', 'rsa', '-f', os.path.join(args.ssh_key_dir, name),
-            '-C', name
-        ])
+        ## without a terminal, ssh-keygen's "Overwrite (y/n)?" for an
+        ## existing key reads end of file and fails instead of replacing it
+        with open(os.devnull, 'r') as devnull:
+            subprocess.check_call([
+                args.ssh_keygen, '-q', '-N', '', '-t', 'rsa', '-f', os.path.join(args.ssh_key_dir, name),
+                '-C', name
+            ], stdin=devnull)
     with open(os.path.join(args.ssh_key_dir, name + '.pub'), 'r') as fh:
         return fh.read()
 
-def _put_user_policy(args, iam, user_name):
+def _try_generate_keypair(args, name):
+    try:
+        return _generate_keypair(args, name)
+    except (subprocess.CalledProcessError, OSError, IOError) as e:
+        LOGGER.error('could not generate key pair for %s: %s', name, e)
+        return None
+
+@instrumentation.timed_phase
+def generate_keypairs(args, names):
+    ## Each key is made by its own ssh-keygen process, so a thread pool keeps
+    ## --keygen_jobs of them running. Returns name -> public key, leaving out
+    ## names whose key could not be generated.
+    pool = ThreadPool(args.keygen_jobs)
+    try:
+        public_keys = pool.map(functools.partial(_try_generate_keypair, args), names)
+    finally:
+        pool.close()
+        pool.join()
+    return dict((name, public_key) for name, public_key in zip(names, public_keys)
+                if public_key is not None)
+
+## the group policy's name; inline user policies are USER_POLICY_PREFIX + user name
+GROUP_POLICY_NAME = 'StartStopTaggedInstances'
+USER_POLICY_PREFIX = 'StartStopTaggedInstances-'
+
+def _policy_document(sid, for_user):
     policy = \
         """
         {
             "Version":"2012-10-17",
             "Statement": [
                 {
-                    "Sid":"StartStopInstances%(user_name)s",
+                    "Sid":"%(sid)s",
                     "Effect": "Allow",
                     "Action": [
                         "ec2:StartInstances",
@@ -120,7 +755,7 @@ def _put_user_policy(args, iam, user_name):
                     ],
                     "Condition": {
                         "StringEquals": {
-                            "ec2:ResourceTag/for_user": "%(user_name)s"
+                            "ec2:ResourceTag/for_user": "%(for_user)s"
                         }
                     },
                     "Resource": [
@@ -129,60 +764,308 @@ def _put_user_policy(args, iam, user_name):
                 }
             ]
        }
-       """ % {'user_name': user_name}
+       """ % {'sid': sid, 'for_user': for_user}
     policy = policy.strip()
     LOGGER.debug('policy is %s', policy)
+    return policy
+
+def _put_user_policy(args, iam, user_name):
     iam.put_user_policy(user_name,
-        'StartStopTaggedInstances-' + user_name,
-        policy,
+        USER_POLICY_PREFIX + user_name,
+        _policy_document('StartStopInstances' + user_name, user_name),
     )
 
+def put_group_policy(args, iam):
+    ## one policy on --default_group covering every member: IAM substitutes
+    ## the calling user's name for ${aws:username}
+    iam.put_group_policy(args.default_group,
+        GROUP_POLICY_NAME,
+        _policy_document('StartStopInstancesOwnTag', '${aws:username}'),
+    )
 
-def wipe_account(args, dbh, iam, ec2, user_name):
-    try:
-        iam.remove_user_from_group(args.default_group, user_name) 
-    except boto.exception.BotoServerError:
-        pass
+def _is_no_such_entity(e):
+    return getattr(e, 'error_code', None) == 'NoSuchEntity'
+
+def _iam_paged(call, response_key, result_key, list_key):
+    marker = None
+    while True:
+        result = call(marker=marker)[response_key][result_key]
+        for item in result[list_key]:
+            yield item
+        if result.get('is_truncated') != 'true':
+            break
+        marker = result['marker']
+
+def iam_user_names(args, iam):
+    return [user['user_name'] for user in _iam_paged(
+        iam.get_all_users, 'list_users_response', 'list_users_result', 'users')]
+
+def group_member_names(args, iam, group_name):
+    return [user['user_name'] for user in _iam_paged(
+        functools.partial(iam.get_group, group_name),
+        'get_group_response', 'get_group_result', 'users')]
 
+def user_policy_names(args, iam, user_name):
+    return list(_iam_paged(
+        functools.partial(iam.get_all_user_policies, user_name),
+        'list_user_policies_response', 'list_user_policies_result', 'policy_names'))
+
+def has_login_profile(args, iam, user_name):
     try:
-        iam.delete_login_profile(user_name) 
-    except boto.exception.BotoServerError:
-        pass
+        iam.get_login_profiles(user_name)
+        return True
+    except boto.exception.BotoServerError as e:
+        if _is_no_such_entity(e):
+            return False
+        raise
+
+def _existing_or_new_public_key(args, name):
+    ## a key that was already mailed out is kept rather than replaced
+    if os.path.exists(os.path.join(args.ssh_key_dir, name + '.pub')):
+        with open(os.path.join(args.ssh_key_dir, name + '.pub'), 'r') as fh:
+            return fh.read()
+    return _generate_keypair(args, name)
+
+## in the order repair_account applies them
+REPAIR_STEPS = ['password', 'login_profile', 'group', 'policy', 'key_pair']
 
+@instrumentation.timed_phase
+def repair_account(args, dbh, iam, ec2, user_name, name, steps, password=None, note=''):
+    if 'password' in steps:
+        ## no password on record, so the only fix is to set a new one
+        password = generate_password(args)
+        try:
+            iam.update_login_profile(user_name, password)
+        except boto.exception.BotoServerError as e:
+            if not _is_no_such_entity(e):
+                raise
+            iam.create_login_profile(user_name, password)
+        dbh.execute("""
+            INSERT OR REPLACE INTO users (user_name, name, note, password)
+            VALUES (:user_name, :name, :note, :password)
+        """, {'user_name': user_name, 'name': name, 'note': note, 'password': password})
+        forget_sent(args, dbh, user_name)
+    if 'login_profile' in steps:
+        iam.create_login_profile(user_name, password)
+    if 'group' in steps:
+        iam.add_user_to_group(args.default_group, user_name)
+    if 'policy' in steps and args.policy_mode == 'user':
+        _put_user_policy(args, iam, user_name)
+    if 'key_pair' in steps:
+        if not os.path.exists(os.path.join(args.ssh_key_dir, user_name + '.pub')):
+            forget_sent(args, dbh, user_name)
+        ec2.import_key_pair(user_name, _existing_or_new_public_key(args, user_name))
+
+## error codes meaning the thing being deleted was already gone
+ABSENT_ERROR_CODES = ['NoSuchEntity', 'InvalidKeyPair.NotFound']
+
+def _wipe_step(result, step, function, *function_args):
     try:
-        iam.delete_user_policy(user_name, 'StartStopTaggedInstances-' + user_name)
-    except boto.exception.BotoServerError:
-        pass
+        function(*function_args)
+        result['deleted'].append(step)
+    except boto.exception.BotoServerError as e:
+        if getattr(e, 'error_code', None) in ABSENT_ERROR_CODES:
+            result['absent'].append(step)
+        else:
+            LOGGER.error('deleting %s of %s failed: %s', step, result['user'], e)
+            result['failed'].append((step, e))
+
+def _delete_user(args, iam, user_name):
     try:
-        ec2.delete_key_pair(user_name)
+        iam.delete_user(user_name)
+    except boto.exception.BotoServerError as e:
+        if args.policy_mode != 'group' or getattr(e, 'error_code', None) != 'DeleteConflict':
+            raise
+        ## an inline policy left over from before migrate_policy.py was run
+        for policy_name in user_policy_names(args, iam, user_name):
+            iam.delete_user_policy(user_name, policy_name)
+        iam.delete_user(user_name)
+
+def wipe_account(args, dbh, iam, ec2, user_name):
+    ## Returns {'user', 'deleted', 'absent', 'failed'}, listing each step by
+    ## name; 'failed' holds (step, error) pairs.
+    result = {'user': user_name, 'deleted': [], 'absent': [], 'failed': []}
+    _wipe_step(result, 'group', iam.remove_user_from_group, args.default_group, user_name)
+    _wipe_step(result, 'login_profile', iam.delete_login_profile, user_name)
+    if args.policy_mode == 'user':
+        _wipe_step(result, 'policy', iam.delete_user_policy,
+                   user_name, USER_POLICY_PREFIX + user_name)
+    _wipe_step(result, 'key_pair', ec2.delete_key_pair, user_name)
+    if 'key_pair' not in dict(result['failed']):
         if os.path.exists(os.path.join(args.ssh_key_dir, user_name)):
             os.unlink(os.path.join(args.ssh_key_dir, user_name))
             os.unlink(os.path.join(args.ssh_key_dir, user_name + '.pub'))
-    except boto.exception.BotoServerError:
-        pass
+    ## IAM refuses to delete a user that still has a group, login profile or policy
+    if len([step for step, error in result['failed'] if step != 'key_pair']) == 0:
+        _wipe_step(result, 'user', _delete_user, args, iam, user_name)
+    else:
+        result['failed'].append(('user', 'skipped because an earlier step failed'))
+
+    ## the password stays on record for as long as the IAM user exists
+    if 'user' not in dict(result['failed']):
+        dbh.execute("""
+            DELETE FROM users WHERE user_name = :user_name
+        """, {'user_name': user_name})
+        clear_steps(args, dbh, user_name)
+        forget_sent(args, dbh, user_name)
+    return result
+
+def _wipe_in_thread(args, dbh, user_name):
+    iam, ec2 = thread_connections(args)
+    return wipe_account(args, dbh, iam, ec2, user_name)
 
+@instrumentation.timed_phase
+def wipe_accounts(args, user_names):
+    ## Tears down many accounts concurrently (--jobs at a time), terminating
+    ## their instances in bulk first.
+    if len(user_names) == 0:
+        return []
+    terminated = {}
+    ec2 = ec2_connection(args)
+    instances = instances_by_user(args, ec2, user_set=set(user_names))
+    failed = terminate_instances(args, ec2, instances)
+    for user_name in instances:
+        terminated[user_name] = failed.get(user_name)
+    pool = ThreadPool(args.jobs)
+    writer = BatchWriter(args)
     try:
-        iam.delete_user(user_name) 
-    except boto.exception.BotoServerError:
-        pass
+        results = pool.map(functools.partial(_wipe_in_thread, args, writer), user_names)
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+    unspool_emails(args, [result['user'] for result in results if 'user' in result['deleted']])
+    for result in results:
+        if result['user'] not in terminated:
+            continue
+        failed = terminated[result['user']]
+        if failed:
+            result['failed'].insert(0, ('instances', 'could not terminate %s' % [instance.id for instance in failed]))
+        else:
+            result['deleted'].insert(0, 'instances')
+    return results
+
+def unspool_emails(args, user_names):
+    ## drops the unsent credential emails of user_names from --spool_dir
+    if len(user_names) == 0 or not os.path.isdir(os.path.join(args.spool_dir, 'new')):
+        return
+    user_names = set(user_names)
+    spool = mailbox.Maildir(args.spool_dir, factory=None, create=False)
+    for key in list(spool.iterkeys()):
+        message = spool.get_message(key)
+        if message.get_subdir() == 'new' and message[SPOOL_ACCOUNT_HEADER] in user_names:
+            spool.remove(key)
 
+def format_wipe_result(result):
+    line = "%-10s deleted: %s" % (result['user'], ','.join(result['deleted']) or '-')
+    if len(result['absent']) > 0:
+        line += "; already absent: %s" % ','.join(result['absent'])
+    if len(result['failed']) > 0:
+        line += "; FAILED: %s" % ', '.join('%s (%s)' % (step, str(error).strip()) for step, error in result['failed'])
+    return line
+
+## Per-user steps, in the order they run, journaled in the steps table as
+## they complete so that --resume can continue an interrupted run.
+PROVISION_STEPS = ['create_user', 'login_profile', 'group', 'keypair', 'policy', 'import_key']
+LAUNCH_STEPS = ['launch', 'tag', 'healthcheck']
+## errors meaning a step that never made it into the journal had completed
+DONE_ERROR_CODES = ['EntityAlreadyExists', 'InvalidKeyPair.Duplicate']
+
+def record_step(args, dbh, user_name, step, detail=None):
     dbh.execute("""
-        DELETE FROM users WHERE user_name = :user_name
+        INSERT OR REPLACE INTO steps (user_name, step, detail, completed)
+        VALUES (:user_name, :step, :detail, :completed)
+    """, {'user_name': user_name, 'step': step, 'detail': detail, 'completed': time.time()})
+
+def clear_steps(args, dbh, user_name, steps=None):
+    if steps is None:
+        dbh.execute("""
+            DELETE FROM steps WHERE user_name = :user_name
+        """, {'user_name': user_name})
+        return
+    for step in steps:
+        dbh.execute("""
+            DELETE FROM steps WHERE user_name = :user_name AND step = :step
+        """, {'user_name': user_name, 'step': step})
+
+def forget_sent(args, dbh, user_name):
+    ## the account's credentials changed, so the email with the old ones
+    ## no longer counts as sent
+    dbh.execute("""
+        DELETE FROM outbox WHERE user_name = :user_name
     """, {'user_name': user_name})
 
-def create_account(args, dbh, iam, ec2, user_name, name, note=''):
-    response = iam.create_user(user_name)
-    user = response.user
-    password = generate_password(args)
-    response = iam.create_login_profile(user_name, password)
-    iam.add_user_to_group(args.default_group, user_name)
-    public_key = _generate_keypair(args, user_name)
-    _put_user_policy(args, iam, user_name)
-    ec2.import_key_pair(user_name, public_key)
+def completed_steps(args, dbh):
+    ## user_name -> {step: detail}
+    done = {}
+    for user_name, step, detail in dbh.execute("""
+        SELECT user_name, step, detail FROM steps
+    """):
+        done.setdefault(user_name, {})[step] = detail
+    return done
+
+def _set_login_profile(iam, user_name, password):
+    try:
+        iam.create_login_profile(user_name, password)
+    except boto.exception.BotoServerError as e:
+        if getattr(e, 'error_code', None) != 'EntityAlreadyExists':
+            raise
+        ## set before the password was journaled, so it is not on record
+        iam.update_login_profile(user_name, password)
+
+@instrumentation.timed_phase
+def create_account(args, dbh, iam, ec2, user_name, name, note='', password=None,
+                   public_key=None, done=None):
+    ## done is set when resuming: it maps the steps an earlier run completed
+    ## to their details (see completed_steps). Those steps are skipped, and an
+    ## "already exists" error from any other step is taken as that step
+    ## having completed without being journaled.
+    resuming = done is not None
+    if not resuming:
+        done = {}
+        clear_steps(args, dbh, user_name)
+    def run_step(step, function, *function_args):
+        if step in done:
+            return
+        try:
+            function(*function_args)
+        except boto.exception.BotoServerError as e:
+            if not resuming or getattr(e, 'error_code', None) not in DONE_ERROR_CODES:
+                raise
+            LOGGER.info('%s for %s had already completed', step, user_name)
+        record_step(args, dbh, user_name, step)
+
+    run_step('create_user', iam.create_user, user_name)
+    if 'login_profile' in done:
+        password = done['login_profile']
+    else:
+        if password is None:
+            password = generate_password(args)
+        if resuming:
+            _set_login_profile(iam, user_name, password)
+        else:
+            iam.create_login_profile(user_name, password)
+        record_step(args, dbh, user_name, 'login_profile', password)
+    run_step('group', iam.add_user_to_group, args.default_group, user_name)
+    if public_key is None:
+        if resuming:
+            public_key = _existing_or_new_public_key(args, user_name)
+        else:
+            public_key = _generate_keypair(args, user_name)
+    if 'keypair' not in done:
+        record_step(args, dbh, user_name, 'keypair')
+    if args.policy_mode == 'user':
+        run_step('policy', _put_user_policy, args, iam, user_name)
+    elif 'policy' not in done:
+        ## covered by the group policy (see put_group_policy)
+        record_step(args, dbh, user_name, 'policy', 'group')
+    run_step('import_key', ec2.import_key_pair, user_name, public_key)
     dbh.execute("""
-        INSERT INTO users (user_name, name, note, password)
+        INSERT OR REPLACE INTO users (user_name, name, note, password)
         VALUES (:user_name, :name, :note, :password)
     """, {'user_name': user_name, 'name': name, 'note': note, 'password': password})
+    if not resuming:
+        forget_sent(args, dbh, user_name)
 
 def get_all_passwords(args, dbh):
     c = dbh.cursor()
@@ -207,113 +1090,574 @@ def _find_active_instances_for(args, ec2, user_name):
         ]
     })
 
+def _chunks(items, size=EC2_BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def describe_instances(args, ec2, instance_ids=None, filters=None):
+    if instance_ids is None:
+        return _describe_instances_paged(ec2, filters)
+    result = []
+    for chunk in _chunks(instance_ids):
+        ## unlike passing InstanceId, filtering on instance-id does not fail the
+        ## whole call when a just-launched instance is not visible yet
+        chunk_filters = dict(filters or {})
+        chunk_filters['instance-id'] = chunk
+        result.extend(_describe_instances_paged(ec2, chunk_filters))
+    return result
+
+def _describe_instances_paged(ec2, filters):
+    result = []
+    next_token = None
+    while True:
+        reservations = ec2.get_all_reservations(
+            filters=filters,
+            max_results=DESCRIBE_PAGE_SIZE,
+            next_token=next_token,
+        )
+        for reservation in reservations:
+            result.extend(reservation.instances)
+        next_token = reservations.next_token
+        if not next_token:
+            break
+    return result
+
+def refresh_instances(args, ec2, instances):
+    if len(instances) == 0:
+        return
+    latest = {}
+    for instance in describe_instances(args, ec2, [instance.id for instance in instances]):
+        latest[instance.id] = instance
+    for instance in instances:
+        if instance.id in latest:
+            instance._update(latest[instance.id])
+
+class PollScheduler(object):
+    ## Keeps a priority queue of when each instance should next be checked;
+    ## next_due() refreshes everything that is due with batched describes.
+    def __init__(self, args, ec2):
+        self.args = args
+        self.ec2 = ec2
+        self._queue = []
+        self._delays = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, user, instance, delay=0):
+        heapq.heappush(self._queue, (time.time() + delay, next(self._counter), user, instance))
+
+    def backoff(self, user, instance):
+        delay = self._delays.get(instance.id, POLL_MIN_DELAY / float(POLL_BACKOFF)) * POLL_BACKOFF
+        delay = min(delay, POLL_DELAY)
+        self._delays[instance.id] = delay
+        self.add(user, instance, delay)
+
+    def next_due(self, deadline=None):
+        if len(self._queue) == 0:
+            return []
+        wait = self._queue[0][0] - time.time()
+        if deadline is not None:
+            wait = min(wait, deadline - time.time())
+        if wait > 0:
+            time.sleep(wait)
+        cutoff = time.time() + POLL_COALESCE
+        due = []
+        while len(self._queue) > 0 and self._queue[0][0] <= cutoff:
+            _, _, user, instance = heapq.heappop(self._queue)
+            due.append((user, instance))
+        refresh_instances(self.args, self.ec2, [instance for user, instance in due])
+        return due
+
+    def drain(self):
+        remaining = [(user, instance) for _, _, user, instance in sorted(self._queue)]
+        self._queue = []
+        return remaining
+
+@instrumentation.timed_phase
 def instances_by_user(args, ec2, user_set=None):
     result = {}
-    instance_tags = ec2.get_all_tags({'resource_type': 'instance', 'key': 'saved_for_user'})
-    for tag in instance_tags:
-        user = tag.value
+    instances = describe_instances(args, ec2, filters={
+        'tag-key': 'saved_for_user',
+        'instance-state-name': ACTIVE_INSTANCE_STATES,
+    })
+    for instance in instances:
+        user = instance.tags.get('saved_for_user')
         if user_set and user not in user_set:
             continue
-        instance = ec2.get_only_instances(instance_ids=[tag.res_id])[0]
-        if instance.state == 'terminated' or instance.state == 'shutting-down':
-            continue
         result.setdefault(user, []).append(instance)
     return result
 
-def make_reservation_for(args, ec2, user_name, launch_args):
-    launch_args['key_name'] = user_name
+CachedInstance = collections.namedtuple('CachedInstance',
+    ['id', 'user', 'state', 'instance_type', 'public_dns_name', 'tagged', 'region'])
+
+def _cached_row(user, instance, now):
+    return {
+        'instance_id': instance.id,
+        'user_name': user,
+        'state': instance.state,
+        'instance_type': instance.instance_type,
+        'public_dns_name': instance.public_dns_name,
+        'tagged': 'for_user' in instance.tags,
+        'region': instance.region.name,
+        'updated': now,
+    }
+
+def _store_instance_rows(dbh, rows):
+    dbh.executemany("""
+        INSERT OR REPLACE INTO instances
+            (instance_id, user_name, state, instance_type, public_dns_name, tagged, region, updated)
+        VALUES (:instance_id, :user_name, :state, :instance_type, :public_dns_name, :tagged, :region, :updated)
+    """, rows)
+
+def store_inventory(args, dbh, instances_by_user):
+    ## replaces the whole cache with a full live inventory
+    now = time.time()
+    rows = []
+    for user, instances in instances_by_user.iteritems():
+        rows.extend(_cached_row(user, instance, now) for instance in instances)
+    with transaction(dbh):
+        dbh.execute('DELETE FROM instances')
+        _store_instance_rows(dbh, rows)
+        dbh.execute("""
+            INSERT OR REPLACE INTO inventory_refreshes (name, refreshed) VALUES ('full', :now)
+        """, {'now': now})
+
+def expire_inventory(args, dbh):
+    dbh.execute("""
+        DELETE FROM inventory_refreshes WHERE name = 'full'
+    """)
+
+def _refresh_transitional_instances(args, dbh, ec2):
+    c = dbh.cursor()
+    c.execute("""
+        SELECT instance_id, user_name FROM instances WHERE state IN (%s)
+    """ % ', '.join('?' * len(TRANSITIONAL_INSTANCE_STATES)), TRANSITIONAL_INSTANCE_STATES)
+    users = dict(c.fetchall())
+    if len(users) == 0:
+        return
+    now = time.time()
+    rows = []
+    for instance in describe_instances(args, ec2, users.keys()):
+        if instance.state in ACTIVE_INSTANCE_STATES:
+            rows.append(_cached_row(users[instance.id], instance, now))
+    with transaction(dbh):
+        dbh.executemany("""
+            DELETE FROM instances WHERE instance_id = ?
+        """, [(instance_id,) for instance_id in users])
+        _store_instance_rows(dbh, rows)
+
+@instrumentation.timed_phase
+def cached_instances_by_user(args, dbh, ec2, user_set=None):
+    ## Like instances_by_user, but answers from the instances table in
+    ## creds.db. The cache is rebuilt when older than --inventory_ttl (or
+    ## with --refresh); otherwise only instances cached in a transitional
+    ## state are re-described.
+    c = dbh.cursor()
+    c.execute("""
+        SELECT refreshed FROM inventory_refreshes WHERE name = 'full'
+    """)
+    row = c.fetchone()
+    if args.refresh or row is None or time.time() - row[0] > args.inventory_ttl:
+        store_inventory(args, dbh, instances_by_user(args, ec2))
+    else:
+        _refresh_transitional_instances(args, dbh, ec2)
+    c.execute("""
+        SELECT instance_id, user_name, state, instance_type, public_dns_name, tagged, region
+        FROM instances ORDER BY user_name, instance_id
+    """)
+    result = {}
+    for instance_id, user, state, instance_type, public_dns_name, tagged, region in c.fetchall():
+        if user_set and user not in user_set:
+            continue
+        result.setdefault(user, []).append(
+            CachedInstance(instance_id, user, state, instance_type, public_dns_name, bool(tagged), region))
+    return result
+
+@instrumentation.timed_phase
+def make_reservation_for(args, ec2, key_name, users, launch_args, journal=None):
+    ## Launches one instance for each of users with key_name in a single
+    ## RunInstances call and tags them straight away, so instances_by_user
+    ## sees them while they are still pending. Returns (instances_by_user,
+    ## users left without an instance). If journal (a dbh or BatchWriter) is
+    ## given, the launch and tag steps are recorded in it.
+    launch_args = dict(launch_args)
+    launch_args['key_name'] = key_name
     launch_args['security_groups'] = launch_args.get('security_groups', []) + [args.default_security_group]
-    reservation = ec2.run_instances(**launch_args)
-    return list(reservation.instances)
+    launch_args['min_count'] = 1
+    launch_args['max_count'] = len(users)
+    try:
+        reservation = ec2.run_instances(**launch_args)
+    except boto.exception.BotoServerError as e:
+        LOGGER.error('RunInstances failed for %s: %s', users, e)
+        return {}, list(users)
+    ## with min_count=1 EC2 may start fewer instances than asked for
+    instances = list(reservation.instances)
+    launched = dict((user, [instance]) for user, instance in zip(users, instances))
+    if journal is not None:
+        ## until it is tagged, the journal is the only link from user to instance
+        for user, user_instances in launched.iteritems():
+            record_step(args, journal, user, 'launch', user_instances[0].id)
+        ## so it is committed now rather than with whatever is written next,
+        ## which may be many minutes away while instances boot
+        if isinstance(journal, BatchWriter):
+            journal.flush()
+    ## a tag that fails here (e.g. the new instance is not visible to
+    ## CreateTags yet) is retried by wait_for_and_tag_instances
+    failed = create_tags_by_user(args, ec2, launched, ['for_user', 'saved_for_user'])
+    if journal is not None:
+        for user in launched:
+            if user not in failed:
+                record_step(args, journal, user, 'tag')
+    return launched, list(users[len(instances):])
 
+def _launch_in_thread(args, launch_args, journal, batch):
+    key_name, users = batch
+    ec2 = ec2_connection(args)
+    return make_reservation_for(args, ec2, key_name, users, launch_args, journal)
+
+@instrumentation.timed_phase
+def launch_instances(args, users, launch_args, journal=None):
+    ## Each user's own key pair forces one RunInstances call per user; with
+    ## --launch_key every instance shares that key, so up to
+    ## LAUNCH_BATCH_SIZE go out per call. Calls run on --jobs threads.
+    ## Returns (instances_by_user, users that got no instance).
+    if args.launch_key:
+        batches = [(args.launch_key, chunk) for chunk in _chunks(users, LAUNCH_BATCH_SIZE)]
+    else:
+        batches = [(user, [user]) for user in users]
+    if len(batches) == 0:
+        return {}, []
+    pool = ThreadPool(args.jobs)
+    try:
+        results = pool.map(functools.partial(_launch_in_thread, args, launch_args, journal), batches)
+    finally:
+        pool.close()
+        pool.join()
+    started_instances = {}
+    failed_users = []
+    for launched, unlaunched in results:
+        started_instances.update(launched)
+        failed_users.extend(unlaunched)
+    return started_instances, failed_users
+
+def _probe_instance(args, probe):
+    user, instance = probe
+    start = time.time()
+    try:
+        subprocess.check_call([
+            args.ssh, '-i', os.path.join(args.ssh_key_dir, args.launch_key or user),
+            '-l', args.ssh_user_name,
+        ] + SSH_OPTIONS + [
+            instance.public_dns_name,
+            '/bin/true'
+        ])
+        return True
+    except subprocess.CalledProcessError:
+        return False
+    finally:
+        instrumentation.record('ssh', 'probe', time.time() - start)
+
+def _ssh_control_options(args):
+    control_path = os.path.expanduser(args.ssh_control_path)
+    control_dir = os.path.dirname(control_path)
+    if control_dir and not os.path.isdir(control_dir):
+        os.makedirs(control_dir, 0700)
+    return SSH_OPTIONS + [
+        '-o', 'BatchMode=yes',
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=' + control_path,
+        '-o', 'ControlPersist=%d' % SSH_CONTROL_PERSIST,
+    ]
+
+def ssh_command(args, user, instance, remote_command):
+    return [
+        args.ssh, '-i', os.path.join(args.ssh_key_dir, args.launch_key or user),
+        '-l', args.ssh_user_name,
+    ] + _ssh_control_options(args) + [
+        instance.public_dns_name,
+        remote_command,
+    ]
+
+def scp_command(args, user, instance, files, remote_dir):
+    return [
+        args.scp, '-r', '-i', os.path.join(args.ssh_key_dir, args.launch_key or user),
+    ] + _ssh_control_options(args) + list(files) + [
+        '%s@%s:%s' % (args.ssh_user_name, instance.public_dns_name, remote_dir),
+    ]
+
+def _run_with_timeout(command, timeout):
+    ## subprocess has no timeout in Python 2, so a timer kills the process;
+    ## returns (exit status, combined stdout and stderr, whether it timed out)
+    with open(os.devnull, 'r') as devnull:
+        ## in its own process group so that children holding the output
+        ## pipe (e.g. a ProxyCommand) are killed along with it
+        process = subprocess.Popen(command, stdin=devnull, preexec_fn=os.setpgrp,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    timed_out = threading.Event()
+    def kill():
+        timed_out.set()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(max(timeout, 0), kill)
+    timer.start()
+    try:
+        output, _ = process.communicate()
+    finally:
+        timer.cancel()
+    return process.returncode, output, timed_out.is_set()
+
+def _run_remote_task(args, kind, task):
+    ## runs one host's commands in order, stopping at the first failure; the
+    ## host's --ssh_timeout covers all of them
+    user, instance, commands = task
+    start = time.time()
+    result = {'user': user, 'instance': instance, 'status': None, 'output': '', 'timed_out': False}
+    try:
+        for command in commands:
+            status, output, timed_out = _run_with_timeout(command,
+                start + args.ssh_timeout - time.time())
+            result['output'] += output
+            result['status'] = status
+            result['timed_out'] = timed_out
+            if status != 0 or timed_out:
+                break
+    except OSError as e:
+        result['output'] += 'could not run %s: %s\n' % (commands[0][0], e)
+    finally:
+        result['duration'] = time.time() - start
+        instrumentation.record('ssh', kind, result['duration'])
+    return result
+
+@instrumentation.timed_phase
+def run_remote(args, kind, tasks):
+    ## tasks are (user, instance, [command, ...]); runs --ssh_jobs hosts at a
+    ## time and returns one result per task with the exit status of the last
+    ## command run ('status', None if none could start), its 'output',
+    ## 'timed_out' and 'duration'
+    if len(tasks) == 0:
+        return []
+    pool = ThreadPool(args.ssh_jobs)
+    try:
+        return pool.map(functools.partial(_run_remote_task, args, kind), tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def remote_succeeded(result):
+    return result['status'] == 0 and not result['timed_out']
+
+## appends the user's public key unless it is already there
+AUTHORIZE_KEY_COMMAND = ('umask 077 && mkdir -p ~/.ssh && '
+    '(grep -qxF %(key)s ~/.ssh/authorized_keys 2>/dev/null || '
+    'echo %(key)s >> ~/.ssh/authorized_keys)')
+
+def install_user_keys(args, instances_by_user):
+    ## An instance launched with --launch_key only accepts that key; this
+    ## adds each user's own public key (the one emailed to them) over ssh
+    ## with the launch key. Returns the instances it could not be added to.
+    tasks = []
+    failed_instances = {}
+    for user, instances in instances_by_user.iteritems():
+        try:
+            with open(os.path.join(args.ssh_key_dir, user + '.pub'), 'r') as fh:
+                key = fh.read().strip()
+        except IOError as e:
+            LOGGER.error('no public key for %s: %s', user, e)
+            failed_instances[user] = list(instances)
+            continue
+        for instance in instances:
+            tasks.append((user, instance, [ssh_command(args, user, instance,
+                AUTHORIZE_KEY_COMMAND % {'key': pipes.quote(key)})]))
+    for result in run_remote(args, 'authorize', tasks):
+        if not remote_succeeded(result):
+            LOGGER.error('could not install the key of %s on %s: %s', result['user'],
+                result['instance'].id, result['output'].strip())
+            failed_instances.setdefault(result['user'], []).append(result['instance'])
+    return failed_instances
+
+@instrumentation.timed_phase
 def healthcheck_instances(args, ec2, instances_by_user):
-    pending_instances = instances_by_user.copy()
+    scheduler = PollScheduler(args, ec2)
+    for user, instances in instances_by_user.iteritems():
+        for instance in instances:
+            scheduler.add(user, instance)
     failed_instances = {}
+    pending_since = {}
     stopping_since = {}
     running_since = {}
-    while len(pending_instances) > 0:
-        for user in pending_instances.keys():
-            instances = pending_instances[user]
-            still_pending = []
-            for instance in instances:
-                status = instance.update()
+    pool = ThreadPool(args.ssh_probe_jobs)
+    try:
+        while len(scheduler) > 0:
+            to_probe = []
+            for user, instance in scheduler.next_due():
+                status = instance.state
                 now = time.time()
-                did_fail = False
-                did_succeed = False
-                if status == 'stopping':
+                ## instances are tagged at launch, so ones still booting
+                ## (e.g. on a rerun or --resume) show up here as well
+                if status == 'pending':
+                    delay = now - pending_since.setdefault(instance.id, now)
+                    if delay > args.instance_pending_wait:
+                        failed_instances.setdefault(user, []).append(instance)
+                    else:
+                        scheduler.backoff(user, instance)
+                elif status == 'stopping':
                     delay = now - stopping_since.setdefault(instance.id, now)
                     if delay > args.instance_stop_wait:
-                        did_fail = True
+                        failed_instances.setdefault(user, []).append(instance)
+                    else:
+                        scheduler.backoff(user, instance)
                 elif status == 'stopped':
-                    did_succeed = True
+                    pass
                 elif status == 'running' or status == 'rebooting':
                     delay = now - running_since.setdefault(instance.id, now)
-                    is_up = False
-                    try:
-                        subprocess.check_call([
-                            'ssh', '-i', os.path.join(args.ssh_key_dir, user),
-                            '-l', args.ssh_user_name,
-                        ] + SSH_OPTIONS + [
-                            instance.public_dns_name,
-                            '/bin/true'
-                        ])
-                        is_up = True
-                    except subprocess.CalledProcessError:
-                        pass
-                    if is_up:
-                        did_succeed = True
-                    elif not is_up:
-                        if delay > args.instance_up_wait:
-                            did_fail = True
+                    to_probe.append(((user, instance), delay))
                 else:
-                    did_fail = True
-                if did_fail:
                     failed_instances.setdefault(user, []).append(instance)
-                elif not did_succeed:
-                    still_pending.append(instance)
-            if len(still_pending) > 0:
-                pending_instances[user] = still_pending
-            else:
-                del pending_instances[user]
-            time.sleep(POLL_DELAY)
+            ## all SSH probes that are due run concurrently
+            is_up_list = pool.map(functools.partial(_probe_instance, args),
+                                  [probe for probe, delay in to_probe])
+            for ((user, instance), delay), is_up in zip(to_probe, is_up_list):
+                if is_up:
+                    continue
+                if delay > args.instance_up_wait:
+                    failed_instances.setdefault(user, []).append(instance)
+                else:
+                    scheduler.backoff(user, instance)
+    finally:
+        pool.close()
+        pool.join()
     return failed_instances
 
-def retag_instances(args, ec2, instances_by_user):
+def _tag_chunks(args, ec2, operation, instances, tags):
+    failed = []
+    for chunk in _chunks(instances):
+        instance_ids = [instance.id for instance in chunk]
+        try:
+            operation(instance_ids, tags)
+        except boto.exception.BotoServerError as e:
+            LOGGER.error('%s %s failed for %s: %s', operation.__name__, tags, instance_ids, e)
+            failed.extend(chunk)
+            continue
+        for instance in chunk:
+            for key, value in tags.iteritems():
+                if value is None:
+                    instance.tags.pop(key, None)
+                else:
+                    instance.tags[key] = value
+    return failed
+
+@instrumentation.timed_phase
+def create_tags_by_user(args, ec2, instances_by_user, tag_names):
+    ## CreateTags applies the same values to every resource, so this makes
+    ## one request per user (per chunk of that user's instances).
+    failed_instances = {}
+    for user, instances in instances_by_user.iteritems():
+        tags = dict((tag_name, user) for tag_name in tag_names)
+        failed = _tag_chunks(args, ec2, ec2.create_tags, instances, tags)
+        if len(failed) > 0:
+            failed_instances[user] = failed
+    return failed_instances
+
+@instrumentation.timed_phase
+def delete_tags_by_user(args, ec2, instances_by_user, tag_names):
+    users_of = {}
+    all_instances = []
     for user, instances in instances_by_user.iteritems():
         for instance in instances:
-            instance.add_tag('for_user', user)
+            users_of[instance.id] = user
+            all_instances.append(instance)
+    tags = dict((tag_name, None) for tag_name in tag_names)
+    failed_instances = {}
+    for instance in _tag_chunks(args, ec2, ec2.delete_tags, all_instances, tags):
+        failed_instances.setdefault(users_of[instance.id], []).append(instance)
+    return failed_instances
+
+def retag_instances(args, ec2, instances_by_user):
+    return create_tags_by_user(args, ec2, instances_by_user, ['for_user'])
 
 def untag_instances(args, ec2, instances_by_user):
+    return delete_tags_by_user(args, ec2, instances_by_user, ['for_user'])
+
+def _call_in_chunks(args, operation, instances_by_user):
+    users_of = {}
+    all_instances = []
+    for user, instances in instances_by_user.iteritems():
+        for instance in instances:
+            users_of[instance.id] = user
+            all_instances.append(instance)
+    failed_instances = {}
+    for chunk in _chunks(all_instances):
+        try:
+            operation([instance.id for instance in chunk])
+            continue
+        except boto.exception.BotoServerError as e:
+            LOGGER.warning('%s failed for a chunk of %d instances, retrying individually: %s',
+                operation.__name__, len(chunk), e)
+        ## one instance in the wrong state fails the whole request
+        for instance in chunk:
+            try:
+                operation([instance.id])
+            except boto.exception.BotoServerError as e:
+                LOGGER.error('%s failed for %s: %s', operation.__name__, instance.id, e)
+                failed_instances.setdefault(users_of[instance.id], []).append(instance)
+    return failed_instances
+
+@instrumentation.timed_phase
+def stop_instances(args, ec2, instances_by_user):
+    return _call_in_chunks(args, ec2.stop_instances, instances_by_user)
+
+@instrumentation.timed_phase
+def terminate_instances(args, ec2, instances_by_user):
+    return _call_in_chunks(args, ec2.terminate_instances, instances_by_user)
+
+@instrumentation.timed_phase
+def wait_for_states(args, ec2, instances_by_user, states, timeout):
+    scheduler = PollScheduler(args, ec2)
     for user, instances in instances_by_user.iteritems():
         for instance in instances:
-            instance.remove_tag('for_user')
+            scheduler.add(user, instance, POLL_MIN_DELAY)
+    deadline = time.time() + timeout
+    while len(scheduler) > 0 and time.time() < deadline:
+        for user, instance in scheduler.next_due(deadline):
+            if instance.state not in states:
+                scheduler.backoff(user, instance)
+    stragglers = {}
+    for user, instance in scheduler.drain():
+        stragglers.setdefault(user, []).append(instance)
+    return stragglers
 
+@instrumentation.timed_phase
 def wait_for_and_tag_instances(args, ec2, instances_by_user):
-    pending_instances = instances_by_user.copy()
-    for user in pending_instances:
-        pending_instances[user] = list(pending_instances[user])
+    scheduler = PollScheduler(args, ec2)
+    for user, instances in instances_by_user.iteritems():
+        for instance in instances:
+            scheduler.add(user, instance)
     failed_instances = {}
-    start_time = time.time()
-    while len(pending_instances) > 0 and time.time() - start_time < args.instance_pending_wait:
-        for user in pending_instances.keys():
-            instances = pending_instances[user]
-            still_pending = []
-            for instance in instances:
-                status = instance.update()
-                if status == 'pending':
-                    still_pending.append(instance)
-                elif status == 'running':
-                    instance.add_tag('for_user', user)
-                    instance.add_tag('saved_for_user', user)
-                else:
-                    failed_instances.setdefault(user, []).append(instance)
-            if len(still_pending) > 0:
-                pending_instances[user] = still_pending
+    deadline = time.time() + args.instance_pending_wait
+    while len(scheduler) > 0 and time.time() < deadline:
+        now_running = {}
+        for user, instance in scheduler.next_due(deadline):
+            status = instance.state
+            if status == 'pending':
+                scheduler.backoff(user, instance)
+            elif status == 'running':
+                now_running.setdefault(user, []).append(instance)
             else:
-                del pending_instances[user]
-        time.sleep(POLL_DELAY)
-    for user, instances in pending_instances.iteritems():
-        failed_instances[user] = failed_instances.get(user, []) + instances
+                failed_instances.setdefault(user, []).append(instance)
+        ## instances are normally tagged at launch; only retry the ones that were not
+        untagged = {}
+        for user, instances in now_running.iteritems():
+            for instance in instances:
+                if instance.tags.get('saved_for_user') != user or instance.tags.get('for_user') != user:
+                    untagged.setdefault(user, []).append(instance)
+        failed_tagging = create_tags_by_user(args, ec2, untagged, ['for_user', 'saved_for_user'])
+        for user, instances in failed_tagging.iteritems():
+            failed_instances.setdefault(user, []).extend(instances)
+    for user, instance in scheduler.drain():
+        failed_instances.setdefault(user, []).append(instance)
     return failed_instances
-
-
@@ -2,45 +2,130 @@
 from __future__ import print_function
 
 import argparse
-import codecs
+import functools
+import logging
 import os
 import os.path
+import sys
+from multiprocessing.pool import ThreadPool
 
 import account_util
 
 ## TODO: create_users.py <number of users>
 ##       create user000 --> userXXX -- assign to students or groups/track?
 
+def assign_passwords(args, roster):
+    passwords = account_util.generate_passwords(args, len(roster))
+    logging.info('Generated %d passwords with %.1f bits of entropy each',
+        len(passwords), account_util.password_entropy(args))
+    return [(name, user_name, password) for (name, user_name), password in zip(roster, passwords)]
+
+def _run_for_users(args, function, items):
+    pool = ThreadPool(args.jobs)
+    writer = account_util.BatchWriter(args)
+    try:
+        return pool.map(functools.partial(function, args, writer), items)
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+
+def report_wipes(results):
+    for result in results:
+        print(account_util.format_wipe_result(result))
+    return [result['user'] for result in results if len(result['failed']) > 0]
+
+def provision_user(args, dbh, entry):
+    ## runs in a worker thread; each user's steps stay in order
+    name, user_name, password, public_key, done = entry
+    iam, ec2 = account_util.thread_connections(args)
+    try:
+        account_util.create_account(args, dbh, iam, ec2, user_name, name,
+            note='From %s' % (args.users_from_list), password=password,
+            public_key=public_key, done=done)
+        return user_name, None
+    except Exception as e:
+        logging.exception('Failed to provision %s', user_name)
+        return user_name, e
+
+def provision_users(args, roster):
+    if args.wipe_first:
+        report_wipes(account_util.wipe_accounts(args,
+            [user_name for name, user_name, password in roster]))
+        ## the wipe terminated instances behind the cached inventory
+        dbh = account_util.connect_db(args)
+        account_util.expire_inventory(args, dbh)
+        dbh.close()
+    if args.policy_mode == 'group':
+        account_util.put_group_policy(args, account_util.iam_connection(args))
+    done = {}
+    finished = []
+    if args.resume:
+        dbh = account_util.connect_db(args)
+        done = account_util.completed_steps(args, dbh)
+        dbh.close()
+        finished = [user_name for name, user_name, password in roster
+                    if set(account_util.PROVISION_STEPS) <= set(done.get(user_name, {}))]
+        if len(finished) > 0:
+            logging.info('Skipping %d users provisioned by an earlier run', len(finished))
+        roster = [entry for entry in roster if entry[1] not in finished]
+    ## keys are generated ahead of time, off the per-user critical path, but
+    ## only where there is no key yet: an existing one may already have been
+    ## mailed out and imported into EC2 (when resuming, create_account picks
+    ## it up; otherwise the account already exists and create_user fails
+    ## before its key is touched)
+    public_keys = account_util.generate_keypairs(args, [user_name for name, user_name, password in roster
+        if not account_util.has_key_files(args, user_name)])
+    results = _run_for_users(args, provision_user,
+        [(name, user_name, password, public_keys.get(user_name),
+          done.get(user_name, {}) if args.resume else None)
+         for name, user_name, password in roster])
+    return [(user_name, None) for user_name in finished] + results
+
 ## XXX: Need to distribute SSH keys somehow?
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+def setup_args(parser):
     parser.add_argument('--init_db', action='store_true', default=False)
     parser.add_argument('--wipe_first', action='store_true', default=False)
     parser.add_argument('--skip_create', action='store_true', default=False)
-    account_util.setup_args(parser)
-    args = parser.parse_args()
+    parser.add_argument('--wipe_only', action='store_true', default=False,
+        help='delete the selected accounts (default: all in --creds_db) and terminate their instances')
+
+def main(args):
     account_util.init_logging(args)
+    if args.resume and (args.wipe_first or args.wipe_only):
+        logging.fatal('--resume cannot be combined with --wipe_first or --wipe_only')
+        return 1
 
-    iam = account_util.connect_iam(args)
-    ec2 = account_util.connect_ec2(args)
     dbh = account_util.connect_db(args)
     if args.init_db:
         account_util.init_db(args, dbh)
         if not os.path.exists(args.ssh_key_dir):
             os.makedirs(args.ssh_key_dir)
 
-    if not args.skip_create:
-        with codecs.open(args.users_from_list, 'r', 'utf-8') as fh:
-            for line in fh:
-                name, user_name, rest = line.split('\t', 2)
-                if args.wipe_first:
-                    account_util.wipe_account(args, dbh, iam, ec2, user_name)
-                account_util.create_account(args, dbh, iam, ec2, user_name, name,
-                    note='From %s' % (args.users_from_list))
+    failed_users = []
+    if args.wipe_only:
+        failed_users = report_wipes(account_util.wipe_accounts(args, account_util.get_users(args)))
+        ## the wipe terminated instances behind the cached inventory
+        account_util.expire_inventory(args, dbh)
+    elif not args.skip_create:
+        results = provision_users(args, assign_passwords(args, account_util.read_roster(args)))
+        for user_name, error in results:
+            if error is None:
+                print("%-10s %s" % (user_name, 'ok'))
+            else:
+                print("%-10s %s: %s" % (user_name, 'FAILED', error))
+                failed_users.append(user_name)
+        print("%d users provisioned, %d failed" % (len(results) - len(failed_users), len(failed_users)))
 
     passwords = account_util.get_all_passwords(args, dbh)
     for user, password in passwords.iteritems():
         print("%-10s %40s" % (user, password))
     
     dbh.close()
+    return 1 if len(failed_users) > 0 else 0
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    setup_args(parser)
+    account_util.setup_args(parser)
+    sys.exit(main(parser.parse_args()))
@@ -1,24 +1,150 @@
 #!/usr/bin/python
 from __future__ import print_function
 import argparse
+import csv
+import json
+import sys
+import time
 
 import account_util
 
+## dump_running.py [--format=table|json|csv] [--watch=SECONDS]
+##
+## With --watch, keeps running: the inventory is pulled from EC2 in bulk
+## every SECONDS and only what changed since the previous pull is printed
+## (instances that appeared or vanished, state and tag changes).
+
+FIELDS = ['user', 'id', 'region', 'state', 'instance_type', 'public_dns_name', 'tagged']
+EVENT_FIELDS = ['time', 'event'] + FIELDS + ['changes']
+
+def setup_args(parser):
+    group = parser.add_argument_group('dump_running')
+    group.add_argument('--format', choices=['table', 'json', 'csv'], default='table')
+    group.add_argument('--watch', type=int, default=None, metavar='SECONDS',
+        help='refresh every SECONDS and print only the changes, until interrupted')
+
+PATTERN = "%(user)12s %(instance)10s %(region)14s %(state)16s %(instance_type)10s %(tagged_p)1s"
+
+def print_table(rows):
+    print(PATTERN % {'user': 'user', 'instance': 'ID', 'region': 'Region', 'state': 'State',
+                     'instance_type': 'Type', 'tagged_p': 'Active?'})
+    for row in rows:
+        tagged_p = 'Y' if row.tagged else 'N'
+        print(PATTERN % {'user': row.user, 'instance': row.id, 'region': row.region, 'state': row.state,
+                         'instance_type': row.instance_type, 'tagged_p': tagged_p })
+
+def print_rows(args, rows):
+    if args.format == 'table':
+        print_table(rows)
+    elif args.format == 'json':
+        json.dump([row._asdict() for row in rows], sys.stdout, indent=2)
+        print()
+    else:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow([getattr(row, field) for field in FIELDS])
+
+def live_rows(args, dbh, ec2):
+    ## one bulk pull from EC2, which also refreshes the cached inventory
+    instances = account_util.instances_by_user(args, ec2)
+    account_util.store_inventory(args, dbh, instances)
+    rows = {}
+    for user, user_instances in instances.iteritems():
+        for instance in user_instances:
+            rows[instance.id] = account_util.CachedInstance(instance.id, user, instance.state,
+                instance.instance_type, instance.public_dns_name, 'for_user' in instance.tags,
+                instance.region.name)
+    return rows
+
+def diff_rows(old, new):
+    ## (event, row, {field: (old value, new value)}) for each instance that
+    ## appeared, vanished or changed
+    events = []
+    for instance_id in sorted(set(old) | set(new)):
+        if instance_id not in old:
+            events.append(('added', new[instance_id], {}))
+        elif instance_id not in new:
+            events.append(('removed', old[instance_id], {}))
+        else:
+            changes = dict((field, (getattr(old[instance_id], field), getattr(new[instance_id], field)))
+                           for field in FIELDS
+                           if getattr(old[instance_id], field) != getattr(new[instance_id], field))
+            if len(changes) > 0:
+                events.append(('changed', new[instance_id], changes))
+    return events
+
+EVENT_PATTERN = "%(time)8s %(event)-8s %(user)12s %(instance)10s %(region)14s %(state)16s %(instance_type)10s %(tagged_p)1s %(changes)s"
+
+def _format_value(value):
+    if value in ('', None):
+        return '-'
+    return value
+
+def _format_changes(changes):
+    return ', '.join('%s %s -> %s' % (field, _format_value(old), _format_value(new))
+                     for field, (old, new) in sorted(changes.iteritems()))
+
+class EventPrinter(object):
+    def __init__(self, args):
+        self.args = args
+        self.csv_writer = None
+        if args.format == 'table':
+            print(EVENT_PATTERN % {'time': 'time', 'event': 'event', 'user': 'user', 'instance': 'ID',
+                'region': 'Region', 'state': 'State', 'instance_type': 'Type', 'tagged_p': 'Active?', 'changes': ''})
+        elif args.format == 'csv':
+            self.csv_writer = csv.writer(sys.stdout)
+            self.csv_writer.writerow(EVENT_FIELDS)
+
+    def print_events(self, now, events):
+        for event, row, changes in events:
+            if self.args.format == 'table':
+                print(EVENT_PATTERN % {'time': time.strftime('%H:%M:%S', time.localtime(now)),
+                    'event': event, 'user': row.user, 'instance': row.id, 'region': row.region,
+                    'state': row.state,
+                    'instance_type': row.instance_type, 'tagged_p': 'Y' if row.tagged else 'N',
+                    'changes': _format_changes(changes)})
+            elif self.args.format == 'json':
+                ## one object per line
+                record = row._asdict()
+                record.update({'time': now, 'event': event,
+                               'changes': dict((field, list(values)) for field, values in changes.iteritems())})
+                print(json.dumps(record, sort_keys=True))
+            else:
+                self.csv_writer.writerow([now, event] + [getattr(row, field) for field in FIELDS] +
+                                         [_format_changes(changes)])
+        sys.stdout.flush()
+
+def watch(args, dbh, ec2):
+    printer = EventPrinter(args)
+    rows = {}
+    while True:
+        start = time.time()
+        new_rows = live_rows(args, dbh, ec2)
+        printer.print_events(start, diff_rows(rows, new_rows))
+        rows = new_rows
+        time.sleep(max(0, start + args.watch - time.time()))
+
+def main(args):
+    account_util.init_logging(args)
+    ec2 = account_util.ec2_connection(args)
+    dbh = account_util.connect_db(args)
+    try:
+        if args.watch:
+            watch(args, dbh, ec2)
+        else:
+            rows = []
+            for user, instances in account_util.cached_instances_by_user(args, dbh, ec2).iteritems():
+                rows.extend(instances)
+            print_rows(args, rows)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dbh.close()
+    return 0
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    setup_args(parser)
     account_util.setup_args(parser)
-    args = parser.parse_args()
-    ec2 = account_util.connect_ec2(args)
-    PATTERN = "%(user)12s %(instance)10s %(state)16s %(instance_type)10s %(tagged_p)1s"
-    print(PATTERN % {'user': 'user', 'instance': 'ID', 'state': 'State', 'instance_type': 'Type',
-                     'tagged_p': 'Active?'})
-    real_instance_tags = ec2.get_all_tags({'resource_type': 'instance', 'key': 'for_user'})
-    tagged_ids = set()
-    for tag in real_instance_tags:
-        tagged_ids.add(tag.res_id)
-    for user, instances in account_util.instances_by_user(args, ec2).iteritems():
-        for instance in instances:
-            tagged_p = 'Y' if instance.id in tagged_ids else 'N'
-            print(PATTERN % {'user': user, 'instance': instance.id, 'state': instance.state,
-                             'instance_type': instance.instance_type, 'tagged_p': tagged_p })
-
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import argparse
+import collections
+import importlib
+import sys
+
+import account_util
+
+## ec2tools.py [common options] COMMAND [options] [then COMMAND [options]]...
+##
+## e.g. ec2tools.py --users_from_list=roster.tsv provision --jobs=8 \
+##          then instances --mode=run then email
+##
+## Runs the other scripts as subcommands of one process. Options before the
+## first command apply to every command. A command's module (and with it
+## boto, pandas, ...) is only imported when that command is run, and the
+## EC2/IAM connections one command opens are reused by the next. Commands
+## run in order; the first one to fail stops the rest.
+
+## command -> (module, option defaults, help)
+COMMANDS = collections.OrderedDict([
+    ('provision', ('create_users', {}, 'create, wipe or resume accounts (create_users.py)')),
+    ('passwords', ('create_users', {'skip_create': True}, 'print the passwords in --creds_db')),
+    ('instances', ('start_instances', {}, 'run, stop, tag or run commands on instances (start_instances.py)')),
+    ('dump', ('dump_running', {}, 'list or watch instances (dump_running.py)')),
+    ('email', ('email_keys', {}, 'render and send credential emails (email_keys.py)')),
+    ('reconcile', ('reconcile', {}, 'bring accounts in line with the roster (reconcile.py)')),
+    ('migrate_policy', ('migrate_policy', {}, 'move users to the group policy (migrate_policy.py)')),
+    ('find_emails', ('find_emails', {}, 'build the roster from group and student lists (find_emails.py)')),
+])
+
+SEPARATOR = 'then'
+
+def usage():
+    lines = ['usage: ec2tools.py [common options] COMMAND [options] [%s COMMAND [options]]...' % SEPARATOR,
+             '', 'commands:']
+    for name, (module_name, defaults, help_text) in COMMANDS.iteritems():
+        lines.append('  %-16s %s' % (name, help_text))
+    lines.append('')
+    lines.append('ec2tools.py COMMAND --help lists the options of COMMAND')
+    return "\n".join(lines) + "\n"
+
+def split_commands(argv):
+    ## [(command, its arguments)], with the common options prepended to each
+    for position, arg in enumerate(argv):
+        if arg in COMMANDS:
+            break
+    else:
+        return None
+    common = argv[:position]
+    commands = []
+    expect_command = True
+    for arg in argv[position:]:
+        if expect_command:
+            if arg not in COMMANDS:
+                return None
+            commands.append((arg, list(common)))
+            expect_command = False
+        elif arg == SEPARATOR:
+            expect_command = True
+        else:
+            commands[-1][1].append(arg)
+    if expect_command:
+        return None
+    return commands
+
+def parse_command(name, command_args):
+    module_name, defaults, help_text = COMMANDS[name]
+    module = importlib.import_module(module_name)
+    parser = argparse.ArgumentParser(prog='ec2tools.py %s' % name, fromfile_prefix_chars='@')
+    module.setup_args(parser)
+    account_util.setup_args(parser)
+    parser.set_defaults(**defaults)
+    return module, parser.parse_args(command_args)
+
+if __name__ == '__main__':
+    if sys.argv[1:] in (['-h'], ['--help']):
+        sys.stdout.write(usage())
+        sys.exit(0)
+    commands = split_commands(sys.argv[1:])
+    if commands is None:
+        sys.stderr.write(usage())
+        sys.exit(2)
+    ## every command's options are checked before the first one runs
+    parsed = [(name,) + parse_command(name, command_args) for name, command_args in commands]
+    for name, module, args in parsed:
+        status = module.main(args)
+        if status:
+            if len(parsed) > 1:
+                sys.stderr.write('ec2tools.py: %s failed, not running the remaining commands\n' % name)
+            sys.exit(status)
@@ -6,16 +6,28 @@ from email.mime.base import MIMEBase
 
 import argparse
 import codecs
+import email.utils
+import functools
+import hashlib
 import logging
+import mailbox
+import multiprocessing
 import socket
 import os.path
 import ssl
+import sys
+import tempfile
+import threading
+import time
 from smtplib import SSLFakeFile
 
 import account_util
+import instrumentation
 
 LOGGER = logging.getLogger(__name__)
 
+SMTP_ATTEMPTS = 3
+
 def setup_args(parser):
     group = parser.add_argument_group('email_keys')
     group.add_argument('--template_file', default='email_template.txt')
@@ -24,12 +36,23 @@ def setup_args(parser):
     group.add_argument('--cc', default=None)
 
     group.add_argument('--smtp_gateway')
+    group.add_argument('--smtp_port', type=int, default=0)
+    group.add_argument('--smtp_plain', action='store_true', default=False,
+        help='use plain SMTP without TLS, e.g. against a local "python -m smtpd" stand-in')
     group.add_argument('--smtp_username')
     group.add_argument('--smtp_password')
 
     group.add_argument('--smtp_certs', default='/etc/ssl/certs/AddTrust_External_Root.pem')
 
-    group.add_argument('--dry_run', action='store_true', default=False)
+    group.add_argument('--dry_run', action='store_true', default=False,
+        help='only render the messages, into a new temporary directory, for inspection')
+    group.add_argument('--resend', action='store_true', default=False,
+        help='send to accounts the outbox already records as sent')
+
+    group.add_argument('--stage', choices=['render', 'send', 'both'], default='both',
+        help='render messages into --spool_dir, send what is spooled there, or both in turn')
+    group.add_argument('--render_jobs', type=int, default=1,
+        help='processes rendering messages in parallel')
 
 class MySMTP_SSL(smtplib.SMTP):
     default_port = 465
@@ -49,6 +72,22 @@ class MySMTP_SSL(smtplib.SMTP):
         self.file = SSLFakeFile(new_socket)
         return new_socket
 
+## spooled messages carry the account they are for and a digest of the
+## credentials they hold in these headers, which are removed before sending
+ACCOUNT_HEADER = account_util.SPOOL_ACCOUNT_HEADER
+CREDENTIALS_HEADER = 'X-EC2Tools-Credentials'
+
+_TEMPLATES = {}
+_TEMPLATE_LOCK = threading.Lock()
+
+def load_template(args):
+    ## read once per process
+    with _TEMPLATE_LOCK:
+        if args.template_file not in _TEMPLATES:
+            with codecs.open(args.template_file, 'r', 'utf-8') as fh:
+                _TEMPLATES[args.template_file] = fh.read()
+        return _TEMPLATES[args.template_file]
+
 def generate_email(args, group_name, to_emails, account, password, key_file):
     message = MIMEMultipart()
     message['Subject'] = args.subject
@@ -56,13 +95,11 @@ def generate_email(args, group_name, to_emails, account, password, key_file):
     message['To'] = ', '.join(to_emails)
     if args.cc:
         message['Cc'] = args.cc
-    with codecs.open(args.template_file, 'r', 'utf-8') as fh:
-        template = fh.read() 
-        filled_template = template.format(
-            group_name=group_name,
-            account=account,
-            password=password,
-        )
+    filled_template = load_template(args).format(
+        group_name=group_name,
+        account=account,
+        password=password,
+    )
     message.attach(MIMEText(filled_template.encode('utf-8'), 'plain', 'UTF-8'))
 
     with open(key_file, 'r') as fh:
@@ -74,37 +111,196 @@ def generate_email(args, group_name, to_emails, account, password, key_file):
 
     return message
 
-def send_email(args, message, to_emails):
-    server = MySMTP_SSL(host=args.smtp_gateway, ca_certs=args.smtp_certs)
-    server.login(args.smtp_username, args.smtp_password)
-    all_to_emails = to_emails
-    if args.cc:
-        all_to_emails = all_to_emails + [args.cc]
-    server.sendmail(args.from_, all_to_emails, message.as_string())
-    server.quit()
+class SMTPSender(object):
+    ## Keeps one logged-in SMTP session open across messages and reconnects
+    ## if the server drops it.
+    def __init__(self, args):
+        self.args = args
+        self.server = None
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-    account_util.setup_args(parser)
-    setup_args(parser)
-    args = parser.parse_args()
+    def _connect(self):
+        if self.args.smtp_plain:
+            server = smtplib.SMTP(host=self.args.smtp_gateway, port=self.args.smtp_port)
+        else:
+            server = MySMTP_SSL(host=self.args.smtp_gateway, port=self.args.smtp_port,
+                                ca_certs=self.args.smtp_certs)
+        if self.args.smtp_username:
+            server.login(self.args.smtp_username, self.args.smtp_password)
+        return server
+
+    def send_string(self, from_addr, recipients, message_string):
+        for attempt in range(SMTP_ATTEMPTS):
+            if self.server is None:
+                self.server = self._connect()
+            start = time.time()
+            try:
+                self.server.sendmail(from_addr, recipients, message_string)
+                instrumentation.record('smtp', 'sendmail', time.time() - start)
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error) as e:
+                LOGGER.warning('SMTP connection lost (%s), reconnecting', e)
+                self.server = None
+                if attempt + 1 == SMTP_ATTEMPTS:
+                    raise
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.server = None
+
+def get_sent_accounts(args, dbh):
+    c = dbh.cursor()
+    c.execute("""
+        SELECT user_name FROM outbox WHERE status = 'sent'
+    """)
+    return set(map(lambda x: x[0], c.fetchall()))
+
+def record_outbox(args, dbh, account, status, error=None):
+    dbh.execute("""
+        INSERT OR REPLACE INTO outbox (user_name, status, error, updated)
+        VALUES (:user_name, :status, :error, :updated)
+    """, {'user_name': account, 'status': status, 'error': error, 'updated': time.time()})
+
+def read_email_roster(args):
+    ## [(group_name, account, to_emails)] from --users_from_list
+    roster = []
+    with codecs.open(args.users_from_list, 'r', 'utf-8') as fh:
+        for line in fh:
+            parts = line.strip().split('\t')
+            roster.append((parts[0], parts[1], parts[2:]))
+    return roster
 
+def open_spool(spool_dir):
+    ## maildir creates its directories readable by the owner only, which
+    ## matters as messages hold passwords and private keys
+    return mailbox.Maildir(spool_dir, factory=None, create=True)
+
+def credentials_digest(password, key_file):
+    with open(key_file, 'r') as fh:
+        return hashlib.sha1(password.encode('utf-8') + fh.read()).hexdigest()
+
+def render_message(args, passwords, entry):
+    ## runs in a worker process; returns the message as a string
+    group_name, account, to_emails = entry
+    key_file = os.path.join(args.ssh_key_dir, account)
+    message = generate_email(args, group_name, to_emails, account, passwords[account], key_file)
+    message[ACCOUNT_HEADER] = account
+    message[CREDENTIALS_HEADER] = credentials_digest(passwords[account], key_file)
+    return message.as_string()
+
+def render_spool(args, dbh, spool):
+    ## Renders a message for every roster account not yet sent to, replacing
+    ## whatever was waiting unsent in the spool (it may hold an old template
+    ## or old credentials). Returns the count rendered.
+    for key in list(spool.iterkeys()):
+        if spool.get_message(key).get_subdir() == 'new':
+            spool.remove(key)
+    passwords = account_util.get_all_passwords(args, dbh)
+    skip = set() if args.resend else get_sent_accounts(args, dbh)
+    entries = [entry for entry in read_email_roster(args) if entry[1] not in skip]
+    LOGGER.info('rendering %d messages, skipping %d accounts already sent', len(entries), len(skip))
+    render = functools.partial(render_message, args, passwords)
+    if args.render_jobs > 1 and len(entries) > 1:
+        pool = multiprocessing.Pool(args.render_jobs)
+        try:
+            messages = pool.map(render, entries)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        messages = map(render, entries)
+    for message in messages:
+        spool.add(mailbox.MaildirMessage(message))
+    return len(messages)
+
+def _is_current(args, passwords, account, digest):
+    if account not in passwords:
+        return False
+    try:
+        return credentials_digest(passwords[account], os.path.join(args.ssh_key_dir, account)) == digest
+    except IOError:
+        return False
+
+def send_spool(args, dbh, spool, sender):
+    ## Sends every message waiting in the spool's new/ directory. Sent
+    ## messages move to cur/; failed ones stay for the next run. Messages
+    ## whose account was wiped or given new credentials since they were
+    ## rendered are dropped.
+    counts = {'sent': 0, 'failed': 0, 'skipped': 0, 'stale': 0}
+    already_sent = set() if args.resend else get_sent_accounts(args, dbh)
+    passwords = account_util.get_all_passwords(args, dbh)
+    for key in sorted(spool.iterkeys()):
+        message = spool.get_message(key)
+        if message.get_subdir() != 'new':
+            continue
+        account = message[ACCOUNT_HEADER]
+        if account in already_sent:
+            LOGGER.info('already sent to %s, skipping', account)
+            message.set_subdir('cur')
+            spool[key] = message
+            counts['skipped'] += 1
+            continue
+        if not _is_current(args, passwords, account, message[CREDENTIALS_HEADER]):
+            LOGGER.warning('credentials of %s changed since the message was rendered; render it again', account)
+            spool.remove(key)
+            counts['stale'] += 1
+            continue
+        recipients = [address for name, address in
+                      email.utils.getaddresses(message.get_all('To', []) + message.get_all('Cc', []))]
+        digest = message[CREDENTIALS_HEADER]
+        del message[ACCOUNT_HEADER]
+        del message[CREDENTIALS_HEADER]
+        try:
+            sender.send_string(message['From'], recipients, message.as_string())
+        except (smtplib.SMTPException, socket.error) as e:
+            LOGGER.error('sending to %s failed: %s', account, e)
+            record_outbox(args, dbh, account, 'failed', str(e))
+            counts['failed'] += 1
+        else:
+            record_outbox(args, dbh, account, 'sent')
+            message[ACCOUNT_HEADER] = account
+            message[CREDENTIALS_HEADER] = digest
+            message.set_subdir('cur')
+            message.add_flag('S')
+            spool[key] = message
+            counts['sent'] += 1
+    return counts
+
+def main(args):
     LOGGER.setLevel(logging.DEBUG)
 
     account_util.init_logging(args)
     
     dbh = account_util.connect_db(args)
-    passwords = account_util.get_all_passwords(args, dbh)
-    dbh.close()
-    with codecs.open(args.users_from_list, 'r', 'utf-8') as fh:
-        for line in fh:
-            parts = line.strip().split('\t')
-            group_name = parts[0]
-            group_account = parts[1]
-            to_emails = parts[2:]
-            password = passwords[group_account]
-            message = generate_email(args, group_name, to_emails, group_account, password,
-                os.path.join(args.ssh_key_dir, group_account))
-            LOGGER.debug('message is %s', message)
-            if not args.dry_run:
-                send_email(args, message, to_emails)
+    ## a dry run never leaves messages where a real run would send them
+    spool_dir = args.spool_dir
+    if args.dry_run:
+        spool_dir = os.path.join(tempfile.mkdtemp(prefix='email-dry-run-'), 'spool')
+    spool = open_spool(spool_dir)
+    counts = None
+    try:
+        if args.stage in ['render', 'both'] or args.dry_run:
+            LOGGER.info('%d messages rendered into %s', render_spool(args, dbh, spool), spool_dir)
+        if args.stage in ['send', 'both'] and not args.dry_run:
+            sender = SMTPSender(args)
+            try:
+                counts = send_spool(args, dbh, spool, sender)
+            finally:
+                sender.close()
+    finally:
+        dbh.close()
+    if counts is not None:
+        LOGGER.info('%(sent)d sent, %(failed)d failed, %(skipped)d already sent, '
+                    '%(stale)d dropped as out of date', counts)
+        if counts['failed'] > 0:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    account_util.setup_args(parser)
+    setup_args(parser)
+    sys.exit(main(parser.parse_args()))
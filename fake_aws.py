@@ -0,0 +1,462 @@
+import collections
+import itertools
+import random
+import smtplib
+import threading
+import time
+
+import boto.exception
+
+## In-process stand-ins for the parts of the EC2, IAM and SMTP APIs that
+## account_util, start_instances.py and email_keys.py use, for benchmark.py.
+## Every call sleeps for the configured latency and is rejected with a
+## throttling error with probability throttle_rate; instances move through
+## pending -> running (-> stopping -> stopped / shutting-down -> terminated)
+## on a timer.
+
+def _server_error(status, code, message=''):
+    if status >= 500 or code in ('IncorrectInstanceState', 'RequestLimitExceeded') or code.startswith('Invalid'):
+        error = boto.exception.EC2ResponseError(status, message or code)
+    else:
+        error = boto.exception.BotoServerError(status, message or code)
+    error.error_code = code
+    return error
+
+class FakeBackend(object):
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def _api(self, operation, throttle_code):
+        with self._lock:
+            self.calls[operation] += 1
+            throttle = self._random.random() < self.throttle_rate
+            if throttle:
+                self.throttled[operation] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if throttle:
+            raise _server_error(503 if throttle_code == 'RequestLimitExceeded' else 400, throttle_code)
+
+class FakeResultSet(list):
+    next_token = None
+
+class FakeResponse(dict):
+    ## like boto's jsonresponse.Element, fields read as keys or attributes
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class FakeReservation(object):
+    def __init__(self, reservation_id, instances):
+        self.id = reservation_id
+        self.instances = instances
+
+class FakeInstance(object):
+    def __init__(self, connection, record, state):
+        self.connection = connection
+        self.region = connection.region
+        self.id = record['id']
+        self.state = state
+        self.tags = dict(record['tags'])
+        self.instance_type = record['instance_type']
+        self.image_id = record['image_id']
+        self.key_name = record['key_name']
+        self.public_dns_name = record['public_dns_name'] if state == 'running' else ''
+
+    def __repr__(self):
+        return 'Instance:%s' % self.id
+
+    def _update(self, updated):
+        self.__dict__.update(updated.__dict__)
+
+    def update(self):
+        self._update(self.connection.get_only_instances([self.id])[0])
+        return self.state
+
+class FakeRegion(object):
+    def __init__(self, name):
+        self.name = name
+
+class FakeKeyPair(object):
+    def __init__(self, name):
+        self.name = name
+
+## instance IDs are unique across all fake regions, as in EC2
+_INSTANCE_IDS = itertools.count(1)
+
+class FakeEC2(FakeBackend):
+    def __init__(self, region='us-fake-1', boot_time=5.0, ssh_delay=2.0, stop_time=3.0,
+                 terminate_time=2.0, image_ids=None, **kwargs):
+        FakeBackend.__init__(self, **kwargs)
+        self.region = FakeRegion(region)
+        ## AMIs that exist in this region; None accepts any
+        self.image_ids = image_ids
+        self.boot_time = boot_time
+        self.ssh_delay = ssh_delay
+        self.stop_time = stop_time
+        self.terminate_time = terminate_time
+        self._instances = collections.OrderedDict()
+        self._key_pairs = set()
+        self._client_tokens = {}
+
+    def _api(self, operation):
+        FakeBackend._api(self, operation, 'RequestLimitExceeded')
+
+    def _jitter(self, seconds):
+        return seconds * self._random.uniform(0.5, 1.5)
+
+    def _state(self, record, now):
+        ## advances record past any transition whose time has come
+        for state, until, next_state in [
+            ('pending', record['running_at'], 'running'),
+            ('stopping', record['stopped_at'], 'stopped'),
+            ('shutting-down', record['terminated_at'], 'terminated'),
+        ]:
+            if record['state'] == state and until is not None and now >= until:
+                record['state'] = next_state
+        return record['state']
+
+    def _describe(self, record, now):
+        return FakeInstance(self, record, self._state(record, now))
+
+    def _records(self, instance_ids):
+        missing = [instance_id for instance_id in instance_ids if instance_id not in self._instances]
+        if len(missing) > 0:
+            raise _server_error(400, 'InvalidInstanceID.NotFound', 'no instances %s' % missing)
+        return [self._instances[instance_id] for instance_id in instance_ids]
+
+    def _matches(self, record, state, filters):
+        for name, values in (filters or {}).iteritems():
+            if not isinstance(values, list):
+                values = [values]
+            if name == 'instance-id':
+                if record['id'] not in values:
+                    return False
+            elif name == 'instance-state-name':
+                if state not in values:
+                    return False
+            elif name == 'tag-key':
+                if not any(value in record['tags'] for value in values):
+                    return False
+            elif name.startswith('tag:'):
+                if record['tags'].get(name[len('tag:'):]) not in values:
+                    return False
+            else:
+                raise _server_error(400, 'InvalidParameterValue', 'unsupported filter %s' % name)
+        return True
+
+    def get_all_reservations(self, instance_ids=None, filters=None, dry_run=False,
+                             max_results=None, next_token=None):
+        self._api('DescribeInstances')
+        now = time.time()
+        with self._lock:
+            if instance_ids:
+                records = self._records(instance_ids)
+            else:
+                records = list(self._instances.values())
+            matching = [self._describe(record, now) for record in records
+                        if self._matches(record, self._state(record, now), filters)]
+        start = int(next_token or 0)
+        result = FakeResultSet()
+        if max_results:
+            page = matching[start:start + max_results]
+            if start + max_results < len(matching):
+                result.next_token = str(start + max_results)
+        else:
+            page = matching[start:]
+        result.extend(FakeReservation('r-%s' % instance.id, [instance]) for instance in page)
+        return result
+
+    get_all_instances = get_all_reservations
+
+    def get_only_instances(self, instance_ids=None, filters=None, dry_run=False, max_results=None):
+        return [instance
+                for reservation in self.get_all_reservations(instance_ids, filters)
+                for instance in reservation.instances]
+
+    def run_instances(self, image_id, min_count=1, max_count=1, key_name=None,
+                      security_groups=None, instance_type='m1.small', client_token=None, **kwargs):
+        self._api('RunInstances')
+        now = time.time()
+        with self._lock:
+            ## like EC2, a repeated ClientToken returns the original launch
+            if client_token is not None and client_token in self._client_tokens:
+                return self._client_tokens[client_token]
+            if key_name is not None and key_name not in self._key_pairs:
+                raise _server_error(400, 'InvalidKeyPair.NotFound', 'no key pair %s' % key_name)
+            if self.image_ids is not None and image_id not in self.image_ids:
+                raise _server_error(400, 'InvalidAMIID.NotFound',
+                    'no image %s in %s' % (image_id, self.region.name))
+            instances = []
+            for i in range(max_count):
+                instance_id = 'i-%08x' % next(_INSTANCE_IDS)
+                record = {
+                    'id': instance_id,
+                    'state': 'pending',
+                    'tags': {},
+                    'instance_type': instance_type,
+                    'image_id': image_id,
+                    'key_name': key_name,
+                    'public_dns_name': '%s.%s.compute.fake' % (instance_id, self.region.name),
+                    'running_at': now + self._jitter(self.boot_time),
+                    'stopped_at': None,
+                    'terminated_at': None,
+                }
+                record['ssh_at'] = record['running_at'] + self._jitter(self.ssh_delay)
+                self._instances[instance_id] = record
+                instances.append(self._describe(record, now))
+        reservation = FakeReservation('r-%s' % instances[0].id, instances)
+        if client_token is not None:
+            self._client_tokens[client_token] = reservation
+        return reservation
+
+    def create_tags(self, resource_ids, tags, dry_run=False):
+        self._api('CreateTags')
+        with self._lock:
+            for record in self._records(resource_ids):
+                record['tags'].update(tags)
+        return True
+
+    def delete_tags(self, resource_ids, tags, dry_run=False):
+        self._api('DeleteTags')
+        with self._lock:
+            for record in self._records(resource_ids):
+                for key in tags:
+                    if not isinstance(tags, dict) or tags[key] is None or record['tags'].get(key) == tags[key]:
+                        record['tags'].pop(key, None)
+        return True
+
+    def _change_state(self, instance_ids, allowed_states, new_state, time_key, delay):
+        now = time.time()
+        with self._lock:
+            records = self._records(instance_ids)
+            for record in records:
+                if self._state(record, now) not in allowed_states:
+                    raise _server_error(400, 'IncorrectInstanceState',
+                        'instance %s is %s' % (record['id'], record['state']))
+            for record in records:
+                if record['state'] in ('stopped', 'terminated', 'shutting-down') and new_state == 'stopping':
+                    continue
+                record['state'] = new_state
+                record[time_key] = now + self._jitter(delay)
+            return [self._describe(record, now) for record in records]
+
+    def stop_instances(self, instance_ids=None, force=False, dry_run=False):
+        self._api('StopInstances')
+        return self._change_state(instance_ids, ['running', 'stopping', 'stopped'],
+                                  'stopping', 'stopped_at', self.stop_time)
+
+    def terminate_instances(self, instance_ids=None, dry_run=False):
+        self._api('TerminateInstances')
+        return self._change_state(instance_ids,
+                                  ['pending', 'running', 'stopping', 'stopped', 'shutting-down', 'terminated'],
+                                  'shutting-down', 'terminated_at', self.terminate_time)
+
+    def import_key_pair(self, key_name, public_key_material, dry_run=False):
+        self._api('ImportKeyPair')
+        with self._lock:
+            if key_name in self._key_pairs:
+                raise _server_error(400, 'InvalidKeyPair.Duplicate', 'key pair %s exists' % key_name)
+            self._key_pairs.add(key_name)
+        return FakeKeyPair(key_name)
+
+    def delete_key_pair(self, key_name, dry_run=False):
+        ## like EC2, deleting a missing key pair succeeds
+        self._api('DeleteKeyPair')
+        with self._lock:
+            self._key_pairs.discard(key_name)
+        return True
+
+    def get_all_key_pairs(self, keynames=None, filters=None, dry_run=False):
+        self._api('DescribeKeyPairs')
+        with self._lock:
+            return [FakeKeyPair(name) for name in sorted(self._key_pairs)
+                    if keynames is None or name in keynames]
+
+    def state_counts(self):
+        now = time.time()
+        with self._lock:
+            return collections.Counter(self._state(record, now) for record in self._instances.values())
+
+    def ssh_ready(self, instance_id):
+        now = time.time()
+        with self._lock:
+            record = self._instances.get(instance_id)
+            return (record is not None and self._state(record, now) == 'running'
+                    and now >= record['ssh_at'])
+
+class FakeIAM(FakeBackend):
+    PAGE_SIZE = 100
+
+    def __init__(self, **kwargs):
+        FakeBackend.__init__(self, **kwargs)
+        self._users = collections.OrderedDict()
+        self._groups = {}
+        self._group_policies = {}
+
+    def _api(self, operation):
+        FakeBackend._api(self, operation, 'Throttling')
+
+    def _user(self, user_name):
+        if user_name not in self._users:
+            raise _server_error(404, 'NoSuchEntity', 'user %s does not exist' % user_name)
+        return self._users[user_name]
+
+    def _page(self, response, result, list_key, items, marker):
+        start = int(marker or 0)
+        page = items[start:start + self.PAGE_SIZE]
+        body = {list_key: page, 'is_truncated': 'false'}
+        if start + self.PAGE_SIZE < len(items):
+            body['is_truncated'] = 'true'
+            body['marker'] = str(start + self.PAGE_SIZE)
+        return {response: {result: body}}
+
+    def create_user(self, user_name, path='/'):
+        self._api('CreateUser')
+        with self._lock:
+            if user_name in self._users:
+                raise _server_error(409, 'EntityAlreadyExists', 'user %s exists' % user_name)
+            self._users[user_name] = {'login_profile': None, 'policies': {}}
+        return FakeResponse(user=FakeResponse(user_name=user_name, path=path))
+
+    def delete_user(self, user_name):
+        self._api('DeleteUser')
+        with self._lock:
+            user = self._user(user_name)
+            in_group = any(user_name in members for members in self._groups.values())
+            if user['login_profile'] is not None or user['policies'] or in_group:
+                raise _server_error(409, 'DeleteConflict', 'user %s still has attachments' % user_name)
+            del self._users[user_name]
+
+    def get_all_users(self, path_prefix='/', marker=None, max_items=None):
+        self._api('ListUsers')
+        with self._lock:
+            items = [{'user_name': user_name} for user_name in self._users]
+        return self._page('list_users_response', 'list_users_result', 'users', items, marker)
+
+    def create_login_profile(self, user_name, password):
+        self._api('CreateLoginProfile')
+        with self._lock:
+            user = self._user(user_name)
+            if user['login_profile'] is not None:
+                raise _server_error(409, 'EntityAlreadyExists', 'login profile exists')
+            user['login_profile'] = password
+
+    def update_login_profile(self, user_name, password):
+        self._api('UpdateLoginProfile')
+        with self._lock:
+            user = self._user(user_name)
+            if user['login_profile'] is None:
+                raise _server_error(404, 'NoSuchEntity', 'no login profile for %s' % user_name)
+            user['login_profile'] = password
+
+    def get_login_profiles(self, user_name):
+        self._api('GetLoginProfile')
+        with self._lock:
+            if self._user(user_name)['login_profile'] is None:
+                raise _server_error(404, 'NoSuchEntity', 'no login profile for %s' % user_name)
+            return {'get_login_profile_response': {'get_login_profile_result': {}}}
+
+    def delete_login_profile(self, user_name):
+        self._api('DeleteLoginProfile')
+        with self._lock:
+            user = self._user(user_name)
+            if user['login_profile'] is None:
+                raise _server_error(404, 'NoSuchEntity', 'no login profile for %s' % user_name)
+            user['login_profile'] = None
+
+    def add_user_to_group(self, group_name, user_name):
+        self._api('AddUserToGroup')
+        with self._lock:
+            self._user(user_name)
+            self._groups.setdefault(group_name, collections.OrderedDict())[user_name] = True
+
+    def remove_user_from_group(self, group_name, user_name):
+        self._api('RemoveUserFromGroup')
+        with self._lock:
+            self._user(user_name)
+            if user_name not in self._groups.get(group_name, {}):
+                raise _server_error(404, 'NoSuchEntity', '%s is not in %s' % (user_name, group_name))
+            del self._groups[group_name][user_name]
+
+    def get_group(self, group_name, marker=None, max_items=None):
+        self._api('GetGroup')
+        with self._lock:
+            items = [{'user_name': user_name} for user_name in self._groups.get(group_name, {})]
+        return self._page('get_group_response', 'get_group_result', 'users', items, marker)
+
+    def put_user_policy(self, user_name, policy_name, policy_json):
+        self._api('PutUserPolicy')
+        with self._lock:
+            self._user(user_name)['policies'][policy_name] = policy_json
+
+    def delete_user_policy(self, user_name, policy_name):
+        self._api('DeleteUserPolicy')
+        with self._lock:
+            policies = self._user(user_name)['policies']
+            if policy_name not in policies:
+                raise _server_error(404, 'NoSuchEntity', 'no policy %s' % policy_name)
+            del policies[policy_name]
+
+    def put_group_policy(self, group_name, policy_name, policy_json):
+        self._api('PutGroupPolicy')
+        with self._lock:
+            self._group_policies.setdefault(group_name, {})[policy_name] = policy_json
+
+    def get_all_user_policies(self, user_name, marker=None, max_items=None):
+        self._api('ListUserPolicies')
+        with self._lock:
+            items = list(self._user(user_name)['policies'])
+        return self._page('list_user_policies_response', 'list_user_policies_result',
+                          'policy_names', items, marker)
+
+class FakeSMTPServer(FakeBackend):
+    ## connect_latency stands in for the TCP + TLS handshake and login;
+    ## drop_rate is the chance that a send finds the connection closed
+    def __init__(self, connect_latency=0.0, drop_rate=0.0, **kwargs):
+        FakeBackend.__init__(self, **kwargs)
+        self.connect_latency = connect_latency
+        self.drop_rate = drop_rate
+        self.messages = []
+
+    def connect(self):
+        ## there is no API throttling to imitate, so throttle_rate is ignored
+        with self._lock:
+            self.calls['connect'] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.connect_latency > 0:
+            time.sleep(self.connect_latency)
+        return FakeSMTP(self)
+
+class FakeSMTP(object):
+    def __init__(self, server):
+        self.server = server
+        self.connected = True
+
+    def login(self, user, password):
+        pass
+
+    def sendmail(self, from_addr, to_addrs, message):
+        server = self.server
+        with server._lock:
+            server.calls['sendmail'] += 1
+            dropped = server._random.random() < server.drop_rate
+        if not self.connected or dropped:
+            self.connected = False
+            raise smtplib.SMTPServerDisconnected('connection dropped')
+        if server.latency > 0:
+            time.sleep(server.latency)
+        with server._lock:
+            server.messages.append((from_addr, to_addrs, message))
+        return {}
+
+    def quit(self):
+        self.connected = False
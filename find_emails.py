@@ -6,74 +6,86 @@ import codecs
 import logging
 import pandas as pd
 import re
+import sys
 
 def clean_name(name):
     return re.sub(r'[^a-zA-Z]', '', name).lower()
 
-def get_last(row):
-    name = row['Student Name']
-    last = name.split(',')[0]
-    return clean_name(last)
+def clean_names(names):
+    return names.str.replace(r'[^a-zA-Z]', '', regex=True).str.lower()
 
-def get_first(row):
-    name = row['Student Name']
-    first = name.split(',')[1]
-    first = first.split(' ')[0]
-    return clean_name(first)
+def add_name_columns(students):
+    parts = students['Student Name'].str.split(',', n=1)
+    students['Last'] = clean_names(parts.str[0])
+    students['First'] = clean_names(parts.str[1].str.split(' ').str[0])
 
-def lookup_student(name, students):
-    first, last = name.split(' ', 1)
-    mask = (students['Last'] == clean_name(last)) & (students['First'] == clean_name(first))
-    if sum(mask) == 0:
-        logging.fatal('Could not find student for %s', name)
-        return None
-    elif sum(mask) > 1:
-        logging.fatal('Found multiple matches for %s:\n%s', name, students[mask])
-        return None
-    else:
-        return students[mask]
+def build_name_index(students):
+    ## (first, last) -> positions of the matching rows in students
+    index = {}
+    for position, key in enumerate(zip(students['First'], students['Last'])):
+        index.setdefault(key, []).append(position)
+    return index
 
-def pd_to_string(item):
-    return item.tolist()[0]
+def lookup_student(name, index):
+    first, last = name.split(' ', 1)
+    return index.get((clean_name(first), clean_name(last)), [])
 
-def make_group_line(group_row, students, seen_emails):
-    emails = []
-    for name in group_row[['student1','student2','student3']]:
-        if name == '-':
-            continue
-        student = lookup_student(name, students)
-        assert(len(student) > 0)
-        email = pd_to_string(student['Email Address'])
-        seen_emails.add(email)
-        emails.append("{name} <{email}>".format(
-            name=pd_to_string(student['Student Name']),
-            email=email,
+def make_group_lines(groups, students):
+    index = build_name_index(students)
+    student_names = students['Student Name'].tolist()
+    student_emails = students['Email Address'].tolist()
+    seen_emails = set()
+    problems = []
+    lines = []
+    for group_row in groups.to_dict('records'):
+        emails = []
+        for name in [group_row['student1'], group_row['student2'], group_row['student3']]:
+            if name == '-':
+                continue
+            positions = lookup_student(name, index)
+            if len(positions) == 0:
+                problems.append('Could not find student for %s' % name)
+                continue
+            elif len(positions) > 1:
+                problems.append('Found multiple matches for %s:\n%s' % (name, students.iloc[positions]))
+                continue
+            email = student_emails[positions[0]]
+            seen_emails.add(email)
+            emails.append(u"{name} <{email}>".format(
+                name=student_names[positions[0]],
+                email=email,
+            ))
+        lines.append(u"{group_name}\t{user_name}\t{email_list}".format(
+            group_name=group_row['group'],
+            user_name=group_row['user'],
+            email_list=u"\t".join(emails)
         ))
-    return u"{group_name}\t{user_name}\t{email_list}".format(
-        group_name=group_row['group'],
-        user_name=group_row['user'],
-        email_list=u"\t".join(emails)
-    )
+    return lines, seen_emails, problems
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+def setup_args(parser):
     parser.add_argument('groups')
     parser.add_argument('students')
     parser.add_argument('output')
-    args = parser.parse_args()
 
+def main(args):
     students = pd.read_csv(args.students, encoding='utf-8')
-    students['Last'] = students.apply(get_last, axis=1)
-    students['First'] = students.apply(get_first, axis=1)
+    add_name_columns(students)
     groups = pd.read_csv(args.groups, encoding='utf-8').fillna('-')
 
-    seen_emails = set()
-    lines = groups.apply(lambda row: make_group_line(row, students, seen_emails), axis=1)
-    seen_email_mask = students.apply(lambda row: row['Email Address'] in seen_emails, axis=1)
-    if sum(seen_email_mask) != len(students):
-        logging.fatal('unseen_emails = %s', students[~seen_email_mask])
-        assert(False)
+    lines, seen_emails, problems = make_group_lines(groups, students)
+    seen_email_mask = students['Email Address'].isin(seen_emails)
+    if not seen_email_mask.all():
+        problems.append('unseen_emails = %s' % students[~seen_email_mask])
+    if len(problems) > 0:
+        for problem in problems:
+            logging.fatal('%s', problem)
+        return 1
     with codecs.open(args.output, 'w', 'utf-8') as fh:
         fh.write("\n".join(lines))
         fh.write("\n")
+    return 0
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    setup_args(parser)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,129 @@
+import atexit
+import codecs
+import contextlib
+import functools
+import json
+import sys
+import threading
+import time
+
+## Opt-in timing of phases, API calls and SSH probes. Nothing is recorded
+## until enable() is called (account_util does this for --profile_report);
+## the report is written when the process exits.
+
+_LOCK = threading.Lock()
+_ENABLED = False
+## (phase, kind, name) -> list of durations in seconds
+_SAMPLES = {}
+## (phase, kind, name) -> retries
+_RETRIES = {}
+## Phases nest per thread. A worker thread that is not inside a phase of its
+## own records against the main thread's current phase.
+_MAIN_PHASES = []
+_THREAD_STATE = threading.local()
+
+PERCENTILES = [50, 90, 99]
+
+def enable(report_path):
+    global _ENABLED
+    if _ENABLED:
+        return
+    _ENABLED = True
+    atexit.register(write_report, report_path)
+
+def _phase_stack():
+    if isinstance(threading.current_thread(), threading._MainThread):
+        return _MAIN_PHASES
+    if getattr(_THREAD_STATE, 'phases', None) is None:
+        _THREAD_STATE.phases = []
+    return _THREAD_STATE.phases
+
+def current_phase():
+    stack = _phase_stack()
+    if len(stack) > 0:
+        return stack[-1]
+    elif len(_MAIN_PHASES) > 0:
+        return _MAIN_PHASES[-1]
+    return '-'
+
+def record(kind, name, duration, retries=0):
+    if not _ENABLED:
+        return
+    key = (current_phase(), kind, name)
+    with _LOCK:
+        _SAMPLES.setdefault(key, []).append(duration)
+        if retries:
+            _RETRIES[key] = _RETRIES.get(key, 0) + retries
+
+@contextlib.contextmanager
+def phase(name):
+    if not _ENABLED:
+        yield
+        return
+    stack = _phase_stack()
+    start = time.time()
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+        record('phase', name, time.time() - start)
+
+def timed_phase(function):
+    ## decorator running each call of function as a phase named after it
+    @functools.wraps(function)
+    def wrapper(*function_args, **function_kwargs):
+        with phase(function.__name__):
+            return function(*function_args, **function_kwargs)
+    return wrapper
+
+def _percentile(ordered, percent):
+    index = int(round((len(ordered) - 1) * percent / 100.0))
+    return ordered[index]
+
+def summarize():
+    with _LOCK:
+        samples = dict((key, list(durations)) for key, durations in _SAMPLES.iteritems())
+        retries = dict(_RETRIES)
+    rows = []
+    for key in sorted(samples):
+        phase_name, kind, name = key
+        ordered = sorted(samples[key])
+        row = {
+            'phase': phase_name,
+            'kind': kind,
+            'name': name,
+            'count': len(ordered),
+            'total': sum(ordered),
+            'retries': retries.get(key, 0),
+        }
+        for percent in PERCENTILES:
+            row['p%d' % percent] = _percentile(ordered, percent)
+        rows.append(row)
+    return rows
+
+def format_table(rows):
+    pattern = "%(phase)-28s %(kind)-6s %(name)-36s %(count)7s %(total)9s %(p50)8s %(p90)8s %(p99)8s %(retries)7s"
+    lines = [pattern % {'phase': 'phase', 'kind': 'kind', 'name': 'name', 'count': 'count',
+                        'total': 'total_s', 'p50': 'p50_ms', 'p90': 'p90_ms', 'p99': 'p99_ms',
+                        'retries': 'retries'}]
+    for row in rows:
+        formatted = dict(row)
+        formatted['total'] = '%.3f' % row['total']
+        for percent in PERCENTILES:
+            formatted['p%d' % percent] = '%.1f' % (row['p%d' % percent] * 1000)
+        lines.append(pattern % formatted)
+    return "\n".join(lines) + "\n"
+
+def write_report(report_path):
+    ## '-' prints the table to stderr, a path ending in .json gets JSON and
+    ## any other path gets the table
+    rows = summarize()
+    if report_path == '-':
+        sys.stderr.write(format_table(rows))
+    elif report_path.endswith('.json'):
+        with codecs.open(report_path, 'w', 'utf-8') as fh:
+            json.dump(rows, fh, indent=2, sort_keys=True)
+    else:
+        with codecs.open(report_path, 'w', 'utf-8') as fh:
+            fh.write(format_table(rows))
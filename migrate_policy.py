@@ -0,0 +1,80 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import argparse
+import functools
+import logging
+import sys
+from multiprocessing.pool import ThreadPool
+
+import boto.exception
+
+import account_util
+
+## migrate_policy.py [--users=...|--users_from_list=...] [--dry_run]
+##
+## Moves accounts from one inline policy per user to the single policy on
+## --default_group used by --policy_mode=group. The group policy is put
+## first so nobody loses access, then the inline policies are deleted,
+## --jobs users at a time. By default every member of --default_group is
+## converted.
+def setup_args(parser):
+    group = parser.add_argument_group('migrate_policy')
+    group.add_argument('--dry_run', action='store_true', default=False)
+
+def remove_inline_policy(args, user_name):
+    ## runs in a worker thread
+    iam = account_util.iam_connection(args)
+    try:
+        iam.delete_user_policy(user_name, account_util.USER_POLICY_PREFIX + user_name)
+        return user_name, 'removed', None
+    except boto.exception.BotoServerError as e:
+        if getattr(e, 'error_code', None) in account_util.ABSENT_ERROR_CODES:
+            return user_name, 'absent', None
+        logging.error('Deleting the inline policy of %s failed: %s', user_name, e)
+        return user_name, 'FAILED', e
+
+def main(args):
+    account_util.init_logging(args)
+
+    iam = account_util.iam_connection(args)
+    members = account_util.group_member_names(args, iam, args.default_group)
+    if args.users or args.users_from_list:
+        user_names = account_util.get_users(args)
+    else:
+        user_names = members
+    ## the group policy does not cover users outside the group, so their
+    ## inline policies stay
+    members = set(members)
+    outside = sorted(set(user_names) - members)
+    user_names = [user_name for user_name in user_names if user_name in members]
+    for user_name in outside:
+        print('%-12s %s' % (user_name, 'skipped: not in %s' % args.default_group))
+    if args.dry_run:
+        print('would put %s on %s and remove the inline policies of %d users' % (
+            account_util.GROUP_POLICY_NAME, args.default_group, len(user_names)))
+        return 0
+
+    account_util.put_group_policy(args, iam)
+    pool = ThreadPool(args.jobs)
+    try:
+        results = pool.map(functools.partial(remove_inline_policy, args), user_names)
+    finally:
+        pool.close()
+        pool.join()
+    for user_name, status, error in results:
+        if error is None:
+            print('%-12s %s' % (user_name, status))
+        else:
+            print('%-12s %s: %s' % (user_name, status, str(error).strip()))
+    failed = [user_name for user_name, status, error in results if error is not None]
+    print('%d users converted, %d failed, %d outside %s' % (
+        len(results) - len(failed), len(failed), len(outside), args.default_group))
+    print('use --policy_mode=group from now on')
+    return 1 if len(failed) > 0 else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    setup_args(parser)
+    account_util.setup_args(parser)
+    sys.exit(main(parser.parse_args()))
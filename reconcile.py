@@ -0,0 +1,194 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import argparse
+import functools
+import logging
+import sys
+from multiprocessing.pool import ThreadPool
+
+import account_util
+import start_instances
+
+## reconcile.py --users_from_list=roster.tsv [--deep] [--launch] [--dry_run]
+##
+## Compares the roster with creds.db, IAM, EC2 key pairs and tagged
+## instances, prints what would be added, removed or repaired and then
+## applies only that.
+def setup_args(parser):
+    group = parser.add_argument_group('reconcile')
+    group.add_argument('--deep', action='store_true', default=False,
+        help='also check login profiles and inline policies (two IAM calls per user)')
+    group.add_argument('--launch', action='store_true', default=False,
+        help='launch instances for roster users that have none')
+    group.add_argument('--keep_extra', action='store_true', default=False,
+        help='do not remove accounts in creds.db that are not on the roster')
+    group.add_argument('--dry_run', action='store_true', default=False)
+    start_instances.setup_launch_args(group)
+
+def _map_users(args, function, user_names):
+    pool = ThreadPool(args.jobs)
+    try:
+        return dict(zip(user_names, pool.map(function, user_names)))
+    finally:
+        pool.close()
+        pool.join()
+
+def gather_state(args, dbh, iam, ec2, roster_users):
+    state = {
+        'db_users': set(account_util.get_all_users(args, dbh)),
+        'iam_users': set(account_util.iam_user_names(args, iam)),
+        'group_members': set(account_util.group_member_names(args, iam, args.default_group)),
+        'key_pairs': set(key_pair.name for key_pair in ec2.get_all_key_pairs()),
+        'instances': account_util.instances_by_user(args, ec2),
+    }
+    if args.deep:
+        existing = [user for user in roster_users if user in state['iam_users']]
+        if args.policy_mode == 'user':
+            policies = _map_users(args,
+                lambda user: account_util.user_policy_names(args, account_util.thread_connections(args)[0], user),
+                existing)
+            state['policies'] = set(user for user, names in policies.iteritems()
+                                    if account_util.USER_POLICY_PREFIX + user in names)
+        else:
+            ## the group policy covers everyone in the group
+            state['policies'] = set(existing)
+        login_profiles = _map_users(args,
+            lambda user: account_util.has_login_profile(args, account_util.thread_connections(args)[0], user),
+            existing)
+        state['login_profiles'] = set(user for user, exists in login_profiles.iteritems() if exists)
+    return state
+
+def make_plan(args, roster, state):
+    plan = {'add': [], 'remove': [], 'repair': {}, 'launch': []}
+    roster_users = set(user_name for name, user_name in roster)
+    for name, user_name in roster:
+        if user_name not in state['iam_users']:
+            plan['add'].append((name, user_name))
+        else:
+            steps = []
+            if user_name not in state['db_users']:
+                steps.append('password')
+            elif args.deep and user_name not in state['login_profiles']:
+                steps.append('login_profile')
+            if user_name not in state['group_members']:
+                steps.append('group')
+            if args.deep and user_name not in state['policies']:
+                steps.append('policy')
+            if user_name not in state['key_pairs']:
+                steps.append('key_pair')
+            if len(steps) > 0:
+                plan['repair'][user_name] = (name, steps)
+        if args.launch and user_name not in state['instances']:
+            plan['launch'].append(user_name)
+    if not args.keep_extra:
+        plan['remove'] = sorted(state['db_users'] - roster_users)
+    return plan
+
+def print_plan(plan):
+    for name, user_name in plan['add']:
+        print("%-8s %-12s %s" % ('add', user_name, name))
+    for user_name in plan['remove']:
+        print("%-8s %-12s" % ('remove', user_name))
+    for user_name, (name, steps) in sorted(plan['repair'].iteritems()):
+        print("%-8s %-12s %s" % ('repair', user_name, ','.join(steps)))
+    for user_name in plan['launch']:
+        print("%-8s %-12s" % ('launch', user_name))
+    print("%d to add, %d to remove, %d to repair, %d to launch" % (
+        len(plan['add']), len(plan['remove']), len(plan['repair']), len(plan['launch'])))
+
+def apply_task(args, dbh, passwords, task):
+    ## runs in a worker thread; each user's steps stay in order
+    kind, user_name, name, extra = task
+    iam, ec2 = account_util.thread_connections(args)
+    try:
+        if kind == 'add':
+            password, public_key, stale = extra
+            if stale:
+                ## a creds.db row without an IAM user is left over from an old run
+                account_util.wipe_account(args, dbh, iam, ec2, user_name)
+            account_util.create_account(args, dbh, iam, ec2, user_name, name,
+                note='From %s' % (args.users_from_list), password=password,
+                public_key=public_key)
+        elif kind == 'repair':
+            account_util.repair_account(args, dbh, iam, ec2, user_name, name, extra,
+                password=passwords.get(user_name),
+                note='From %s' % (args.users_from_list))
+        return kind, user_name, None
+    except Exception as e:
+        logging.exception('Failed to %s %s', kind, user_name)
+        return kind, user_name, e
+
+def apply_plan(args, plan, state, passwords):
+    if args.policy_mode == 'group' and (len(plan['add']) > 0 or len(plan['repair']) > 0):
+        account_util.put_group_policy(args, account_util.iam_connection(args))
+    tasks = []
+    new_passwords = account_util.generate_passwords(args, len(plan['add']))
+    public_keys = account_util.generate_keypairs(args, [user_name for name, user_name in plan['add']])
+    for (name, user_name), password in zip(plan['add'], new_passwords):
+        tasks.append(('add', user_name, name,
+            (password, public_keys.get(user_name), user_name in state['db_users'])))
+    for user_name, (name, steps) in sorted(plan['repair'].iteritems()):
+        tasks.append(('repair', user_name, name, steps))
+
+    pool = ThreadPool(args.jobs)
+    writer = account_util.BatchWriter(args)
+    try:
+        results = pool.map(functools.partial(apply_task, args, writer, passwords), tasks)
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+
+    for result in account_util.wipe_accounts(args, plan['remove']):
+        error = None
+        if len(result['failed']) > 0:
+            error = account_util.format_wipe_result(result)
+        results.append(('remove', result['user'], error))
+
+    ec2 = account_util.ec2_connection(args)
+    failed_adds = set(user_name for kind, user_name, error in results
+                      if kind == 'add' and error is not None)
+    to_launch = [user_name for user_name in plan['launch'] if user_name not in failed_adds]
+    if len(to_launch) > 0:
+        failed_launches = set(start_instances.launch_for_users(args, ec2, to_launch, {}))
+        for user_name in to_launch:
+            error = 'instance did not come up' if user_name in failed_launches else None
+            results.append(('launch', user_name, error))
+    return results
+
+def main(args):
+    account_util.init_logging(args)
+    if args.launch:
+        try:
+            account_util.image_ids(args)
+        except ValueError as e:
+            logging.fatal('%s', e)
+            return 1
+
+    roster = account_util.read_roster(args)
+    dbh = account_util.connect_db(args)
+    iam, ec2 = account_util.thread_connections(args)
+    state = gather_state(args, dbh, iam, ec2, [user_name for name, user_name in roster])
+    plan = make_plan(args, roster, state)
+    print_plan(plan)
+    if args.dry_run:
+        dbh.close()
+        return 0
+
+    results = apply_plan(args, plan, state, account_util.get_all_passwords(args, dbh))
+    if len(plan['remove']) > 0 or len(plan['launch']) > 0:
+        account_util.expire_inventory(args, dbh)
+    dbh.close()
+
+    failed = [(kind, user_name, error) for kind, user_name, error in results if error is not None]
+    for kind, user_name, error in failed:
+        print("%-8s %-12s FAILED: %s" % (kind, user_name, error))
+    print("%d changes applied, %d failed" % (len(results) - len(failed), len(failed)))
+    return 1 if len(failed) > 0 else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    setup_args(parser)
+    account_util.setup_args(parser)
+    sys.exit(main(parser.parse_args()))
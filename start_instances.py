@@ -1,86 +1,281 @@
 #!/usr/bin/python
+from __future__ import print_function
 import argparse
 import logging
 import sys
 import codecs
+import os
+import os.path
 
 import account_util
 
 ## startstop_instances.py --mode={start,stop} --ami=ami --type=type
-def setup_args(parser):
-    parser.add_argument('--mode', choices=['run','stop','untag','retag','terminate'], required=True)
-    parser.add_argument('--ami', default='ami-b5a7ea85') # US West Oregon, HVM, 64-bit, Amazon Linux AMI
+## start_instances.py --mode=exec --command='sudo yum -y install gcc'
+## start_instances.py --mode=push --files data.tar.gz setup.sh --remote_dir=hw4
+def setup_launch_args(parser):
+    ## also used by reconcile.py --launch
+    parser.add_argument('--ami', default='ami-b5a7ea85', # US West Oregon, HVM, 64-bit, Amazon Linux AMI
+        help='an AMI, or region=AMI,... with one for each region in --aws_region')
     parser.add_argument('--type', default='t2.micro')
 
+def setup_args(parser):
+    parser.add_argument('--mode', choices=['run','stop','untag','retag','terminate','exec','push'], required=True)
+    setup_launch_args(parser)
+    parser.add_argument('--wait', action='store_true', default=False,
+        help='for stop/terminate, wait until every instance has reached the final state')
+    parser.add_argument('--command', default=None,
+        help='for exec, the shell command to run on each running instance')
+    parser.add_argument('--files', nargs='+', default=[],
+        help='for push, local files or directories to copy to each running instance')
+    parser.add_argument('--remote_dir', default='.',
+        help='for push, the directory to copy into (created if missing)')
+    parser.add_argument('--output_dir', default=None,
+        help='for exec/push, save each host\'s output as USER-INSTANCE.log here '
+             'instead of printing it')
+    parser.add_argument('--retry_file', default=None,
+        help='for exec/push, write "--users=..." for the users that failed here; '
+             'pass it back as @FILE (instead of --users/--users_from_list) to retry just those')
+
+def launch_for_users(args, ec2, users, existing_instances, resumed_instances=None):
+    ## resumed_instances are instances an interrupted run launched (and may
+    ## not have tagged); they are waited on and tagged instead of replaced
+    journal = account_util.BatchWriter(args)
+    try:
+        started_instances, failed_users = account_util.launch_instances(args, users, {
+            'image_id': account_util.launch_image_id(args),
+            'instance_type': args.type,
+        }, journal)
+        started_instances.update(resumed_instances or {})
+        failed_instances = account_util.wait_for_and_tag_instances(args, ec2, started_instances)
+        for user in started_instances:
+            if user not in failed_instances:
+                account_util.record_step(args, journal, user, 'tag')
+        started_instances.update(existing_instances)
+        for k, v in account_util.healthcheck_instances(args, ec2, started_instances).iteritems():
+            failed_instances[k] = failed_instances.get(k, []) + v
+        if args.launch_key:
+            ## students log in with their own key, not the shared launch key
+            healthy_instances = {}
+            for user, instances in started_instances.iteritems():
+                if user not in failed_instances:
+                    healthy_instances[user] = [instance for instance in instances
+                                               if instance.state == 'running']
+            for k, v in account_util.install_user_keys(args, healthy_instances).iteritems():
+                failed_instances[k] = failed_instances.get(k, []) + v
+        for user in started_instances:
+            if user not in failed_instances:
+                account_util.record_step(args, journal, user, 'healthcheck')
+        _log_failures('terminate', account_util.terminate_instances(args, ec2, failed_instances))
+        ## a resumed run launches new instances in place of the terminated ones
+        for user in failed_instances:
+            account_util.clear_steps(args, journal, user, account_util.LAUNCH_STEPS)
+    finally:
+        journal.close()
+    return failed_instances.keys() + failed_users
+
+def _resumed_instances(args, ec2, done, users):
+    ## an instance launched but never tagged is invisible to instances_by_user;
+    ## the journal has its ID
+    launched = dict((done[user]['launch'], user) for user in users
+                    if 'launch' in done.get(user, {}))
+    resumed = {}
+    if len(launched) > 0:
+        for instance in account_util.describe_instances(args, ec2, launched.keys(),
+                filters={'instance-state-name': account_util.ACTIVE_INSTANCE_STATES}):
+            resumed.setdefault(launched[instance.id], []).append(instance)
+    return resumed
+
 def run_instances(args):
     user_list = account_util.get_users(args)
-    ec2 = account_util.connect_ec2(args)
+    ec2 = account_util.ec2_connection(args)
     existing_instances = account_util.instances_by_user(args, ec2)
-    started_instances = {}
-    for user in user_list:
-        if user not in existing_instances:
-            started_instances[user] = account_util.make_reservation_for(args, ec2, user, {
-                'image_id': args.ami,
-                'instance_type': args.type,
-            })
-    failed_instances = account_util.wait_for_and_tag_instances(args, ec2, started_instances)
-    started_instances.update(existing_instances)
-    for k, v in account_util.healthcheck_instances(args, ec2, started_instances).iteritems():
-        failed_instances[k] = failed_instances.get(k, []) + v
-    for user, instances in failed_instances.iteritems():
+    to_check = existing_instances
+    resumed_instances = {}
+    if args.resume:
+        dbh = account_util.connect_db(args)
+        done = account_util.completed_steps(args, dbh)
+        dbh.close()
+        ## instances that already passed the healthcheck are left alone
+        to_check = dict((user, instances) for user, instances in existing_instances.iteritems()
+                        if 'healthcheck' not in done.get(user, {}))
+        resumed_instances = _resumed_instances(args, ec2, done,
+            [user for user in user_list if user not in existing_instances])
+    return launch_for_users(args, ec2,
+        [user for user in user_list
+         if user not in existing_instances and user not in resumed_instances],
+        to_check, resumed_instances)
+
+def _log_failures(action, failed_instances):
+    for user, instances in sorted(failed_instances.iteritems()):
+        logging.error('Failed to %s instances of %s: %s', action, user,
+            [instance.id for instance in instances])
+
+def _select_states(instances_by_user, states):
+    result = {}
+    for user, instances in instances_by_user.iteritems():
+        selected = [instance for instance in instances if instance.state in states]
+        if len(selected) > 0:
+            result[user] = selected
+    return result
+
+def _wait_and_report(args, ec2, instances_by_user, states, timeout, failed=None):
+    ## failed instances (ones the request was refused for) are not waited
+    ## on, but are reported along with the stragglers
+    failed_ids = set(instance.id for instances in (failed or {}).itervalues() for instance in instances)
+    to_wait = {}
+    for user, instances in instances_by_user.iteritems():
+        waiting_for = [instance for instance in instances if instance.id not in failed_ids]
+        if len(waiting_for) > 0:
+            to_wait[user] = waiting_for
+    stragglers = account_util.wait_for_states(args, ec2, to_wait, states, timeout)
+    for user, instances in (failed or {}).iteritems():
+        stragglers.setdefault(user, []).extend(instances)
+    total = sum(len(instances) for instances in instances_by_user.itervalues())
+    waiting = sum(len(instances) for instances in stragglers.itervalues())
+    print('%d of %d instances reached %s' % (total - waiting, total, '/'.join(states)))
+    for user, instances in sorted(stragglers.iteritems()):
         for instance in instances:
-            try:
-                instance.terminate()
-            except boto.exception.EC2REsponseError, e:
-                logging.error('error terminating instance %s: %s', instance.id, e)
-    return failed_instances.keys()
+            print('%-12s %10s %16s' % (user, instance.id, instance.state))
+    return stragglers
 
 def stop_instances(args):
     user_set = set(account_util.get_users(args))
-    ec2 = account_util.connect_ec2(args)
-    for user, instances in account_util.instances_by_user(args, ec2, user_set=user_set).iteritems():
-        for instance in instances:
-            logging.warning('Stopping %s', instance)
-            instance.stop()
+    ec2 = account_util.ec2_connection(args)
+    active = account_util.instances_by_user(args, ec2, user_set=user_set)
+    ## a pending instance cannot be stopped yet (and would fail the whole
+    ## StopInstances request it is in), so it is reported as failed instead
+    pending = _select_states(active, ['pending'])
+    to_stop = _select_states(active, ['running', 'stopping', 'stopped'])
+    logging.warning('Stopping %d instances', sum(len(instances) for instances in to_stop.itervalues()))
+    failed = account_util.stop_instances(args, ec2, to_stop)
+    for user, user_instances in pending.iteritems():
+        failed.setdefault(user, []).extend(user_instances)
+    _log_failures('stop', failed)
+    if args.wait:
+        return _wait_and_report(args, ec2, active, ['stopped', 'terminated'], args.instance_stop_wait, failed)
+    return failed
 
 def terminate_instances(args):
     user_set = set(account_util.get_users(args))
-    ec2 = account_util.connect_ec2(args)
-    for user, instances in account_util.instances_by_user(args, ec2, user_set=user_set).iteritems():
-        for instance in instances:
-            logging.warning('Terminating %s', instance)
-            instance.terminate()
+    ec2 = account_util.ec2_connection(args)
+    to_terminate = account_util.instances_by_user(args, ec2, user_set=user_set)
+    logging.warning('Terminating %d instances', sum(len(instances) for instances in to_terminate.itervalues()))
+    failed = account_util.terminate_instances(args, ec2, to_terminate)
+    _log_failures('terminate', failed)
+    if args.wait:
+        return _wait_and_report(args, ec2, to_terminate, ['terminated'], args.instance_terminate_wait, failed)
+    return failed
 
 def untag_instances(args):
     user_set = set(account_util.get_users(args))
-    ec2 = account_util.connect_ec2(args) 
-    account_util.untag_instances(args, ec2, account_util.instances_by_user(args, ec2, user_set=user_set))
+    ec2 = account_util.ec2_connection(args)
+    failed = account_util.untag_instances(args, ec2, account_util.instances_by_user(args, ec2, user_set=user_set))
+    _log_failures('untag', failed)
+    return failed
 
 def retag_instances(args):
     user_set = set(account_util.get_users(args))
-    ec2 = account_util.connect_ec2(args) 
-    account_util.retag_instances(args, ec2, account_util.instances_by_user(args, ec2, user_set=user_set))
+    ec2 = account_util.ec2_connection(args)
+    failed = account_util.retag_instances(args, ec2, account_util.instances_by_user(args, ec2, user_set=user_set))
+    _log_failures('retag', failed)
+    return failed
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-    setup_args(parser)
-    account_util.setup_args(parser)
-    args = parser.parse_args()
+def _remote_commands(args, user, instance):
+    if args.mode == 'exec':
+        return [account_util.ssh_command(args, user, instance, args.command)]
+    ## the mkdir opens the shared connection that the copy then reuses
+    return [
+        account_util.ssh_command(args, user, instance, "mkdir -p '%s'" % args.remote_dir),
+        account_util.scp_command(args, user, instance, args.files, args.remote_dir),
+    ]
+
+def _report_remote(args, results, missing):
+    for result in results:
+        if result['timed_out']:
+            status = 'timed out'
+        elif result['status'] is None:
+            status = 'not run'
+        else:
+            status = 'exit %d' % result['status']
+        print('%-12s %10s %-10s %6.1fs' % (result['user'], result['instance'].id, status,
+                                            result['duration']))
+        if args.output_dir:
+            with open(os.path.join(args.output_dir, '%s-%s.log' % (result['user'], result['instance'].id)), 'w') as fh:
+                fh.write(result['output'])
+        elif result['output']:
+            for line in result['output'].splitlines():
+                print('    %s' % line)
+    for user in missing:
+        print('%-12s %10s %-10s' % (user, '-', 'no running instance'))
+
+def remote_instances(args):
+    user_list = account_util.get_users(args)
+    ec2 = account_util.ec2_connection(args)
+    if args.output_dir and not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    running = _select_states(account_util.instances_by_user(args, ec2, user_set=set(user_list)), ['running'])
+    missing = [user for user in user_list if user not in running]
+    tasks = []
+    for user, instances in sorted(running.iteritems()):
+        for instance in instances:
+            tasks.append((user, instance, _remote_commands(args, user, instance)))
+    results = account_util.run_remote(args, args.mode, tasks)
+    _report_remote(args, results, missing)
+
+    failed_results = [result for result in results if not account_util.remote_succeeded(result)]
+    print('%d of %d hosts succeeded, %d users without a running instance' % (
+        len(results) - len(failed_results), len(results), len(missing)))
+    failed = sorted(set([result['user'] for result in failed_results] + missing))
+    if len(failed) > 0:
+        logging.error('Failed for %s', ','.join(failed))
+        if args.retry_file:
+            with open(args.retry_file, 'w') as fh:
+                fh.write('--users=%s\n' % ','.join(failed))
+            logging.error('Rerun with @%s to retry only these users', args.retry_file)
+    return failed
+
+def main(args):
     account_util.init_logging(args)
 
     if args.mode == 'run':
         if args.ami is None:
             logging.fatal('Need to specify AMI')
-            sys.exit(1)
+            return 1
+        try:
+            account_util.image_ids(args)
+        except ValueError as e:
+            logging.fatal('%s', e)
+            return 1
         failed = run_instances(args)
         if len(failed):
             logging.error('Failed to start instances for %s', sorted(failed))
     elif args.mode == 'untag':
-        untag_instances(args)
+        failed = untag_instances(args)
     elif args.mode == 'retag':
-        retag_instances(args)
+        failed = retag_instances(args)
     elif args.mode == 'stop':
-        stop_instances(args)
+        failed = stop_instances(args)
     elif args.mode == 'terminate':
-        terminate_instances(args)
+        failed = terminate_instances(args)
+    elif args.mode in ['exec', 'push']:
+        if args.mode == 'exec' and not args.command:
+            logging.fatal('Need to specify --command')
+            return 1
+        if args.mode == 'push' and len(args.files) == 0:
+            logging.fatal('Need to specify --files')
+            return 1
+        ## these leave instance state and tags alone, so the inventory stays valid
+        failed = remote_instances(args)
+        return 1 if len(failed) > 0 else 0
+
+    ## every mode changes instance state or tags behind the cached inventory
+    dbh = account_util.connect_db(args)
+    account_util.expire_inventory(args, dbh)
+    dbh.close()
+    return 1 if len(failed) > 0 else 0
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    setup_args(parser)
+    account_util.setup_args(parser)
+    sys.exit(main(parser.parse_args()))